@@ -5,8 +5,14 @@ __version__ = "0.1.4"
 from ._optimizer import JaccardLabelImageOptimizer, \
     SparseAnnotatedBinaryImageOptimizer, \
     MeanSquaredErrorImageOptimizer, \
+    PeakSignalToNoiseRatioImageOptimizer, \
+    StructuralSimilarityImageOptimizer, \
     Optimizer, \
     Workflow
 
+from ._history import EvaluationHistory
+from ._distributed import Broker, run_worker
+from ._jobs import JobQueue, OptimizationJob
+
 from napari_workflow_optimizer.gui._dock_widget import napari_experimental_provide_dock_widget
 
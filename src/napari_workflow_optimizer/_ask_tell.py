@@ -0,0 +1,54 @@
+import numpy as np
+
+
+class AskTellStrategy():
+    """
+    Elitist evolution strategy which can be driven from outside: ask() proposes parameter vectors and
+    tell() reports their quality. New candidates are sampled around the best parameters found so far.
+    The step size per parameter starts at 5% of the parameter values, as the initial simplex of scipy's
+    Nelder-Mead does, and is adapted according to the 1/5th success rule.
+
+    As every told result is compared to the best result so far, results may be told in any order,
+    late, or never. Failed evaluations are told with quality None or NaN.
+    """
+    def __init__(self, x0, seed=None):
+        self._x0 = np.asarray(x0, dtype=float)
+        self._best_x = self._x0.copy()
+        self._best_quality = None
+        self._sigma = np.where(self._x0 != 0, 0.05 * np.abs(self._x0), 0.00025)
+        self._random = np.random.default_rng(seed)
+        self._x0_asked = False
+
+    def ask(self, n=1):
+        """
+        Returns a list of n parameter vectors which should be evaluated next.
+        """
+        result = []
+        if not self._x0_asked:
+            self._x0_asked = True
+            result.append(self._x0.copy())
+        while len(result) < n:
+            result.append(self._best_x + self._sigma * self._random.standard_normal(len(self._best_x)))
+        return result
+
+    def tell(self, vectors, qualities):
+        """
+        Updates the strategy with the measured qualities (higher is better) of given parameter vectors.
+        """
+        successes = 0
+        for x, quality in zip(vectors, qualities):
+            if quality is None or np.isnan(quality):
+                continue
+            if self._best_quality is None or quality > self._best_quality:
+                self._best_quality = quality
+                self._best_x = np.asarray(x, dtype=float)
+                successes += 1
+        if len(vectors) > 0:
+            success_rate = successes / len(vectors)
+            self._sigma = self._sigma * np.exp((success_rate - 0.2) / (1 - 0.2) / 3)
+
+    def get_best(self):
+        """
+        Returns the best parameter vector told so far and its quality.
+        """
+        return self._best_x.copy(), self._best_quality
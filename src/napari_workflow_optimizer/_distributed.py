@@ -0,0 +1,125 @@
+import os
+import pickle
+import time
+import uuid
+from queue import Empty
+
+import numpy as np
+
+
+class Broker():
+    """
+    Distributes evaluations of an optimizer's ask/tell search to workers via a pair of queues.
+
+    The problem - a copy of the optimizer including its settings and workflow, target task and reference image - is
+    written once to a file in a directory all workers can read. Tasks sent to workers only contain the path of this
+    file and the parameters to evaluate. Any queue with put() and get(timeout=...) works, e.g. multiprocessing queues for local workers
+    or queues backed by a shared file system or message broker for remote ones.
+
+    Evaluations which do not return within timeout seconds are told as failed, so that the search does not stall.
+    If their result arrives later, it is told as well and replaces the failure in the history.
+    Several brokers may share a result queue: results of other brokers' problems are put back into the queue.
+    """
+    def __init__(self, optimizer, target_task, annotation, task_queue, result_queue, directory, timeout=60):
+        from ._optimizer import without_viewer
+
+        self._optimizer = optimizer
+        self._task_queue = task_queue
+        self._result_queue = result_queue
+        self._timeout = timeout
+
+        self._problem_filename = os.path.join(str(directory), "problem_" + uuid.uuid4().hex + ".pickle")
+        with open(self._problem_filename, "wb") as file:
+            pickle.dump((optimizer._copy_for(without_viewer(optimizer._workflow)), target_task,
+                         np.asarray(annotation)), file)
+
+        self._counter = 0
+        self._pending = {}
+        self._expired = {}
+
+    def run(self, max_evaluations=100, num_parallel=4):
+        """
+        Runs the search until max_evaluations results (including failed ones) were told to the optimizer,
+        keeping up to num_parallel evaluations in flight.
+
+        Returns
+        -------
+        List of numbers corresponding to the not-constant numeric parameters of the best evaluated setting.
+        """
+        optimizer = self._optimizer
+        num_told = 0
+        num_sent = 0
+        while num_told < max_evaluations:
+            # keep workers busy
+            num_missing = min(num_parallel - len(self._pending), max_evaluations - num_sent)
+            if num_missing > 0:
+                for x in optimizer.ask(num_missing):
+                    self._send(x)
+                    num_sent += 1
+
+            try:
+                problem_filename, evaluation_id, quality = self._result_queue.get(timeout=0.05)
+                if problem_filename != self._problem_filename:
+                    self._result_queue.put((problem_filename, evaluation_id, quality))
+                elif evaluation_id in self._pending:
+                    x, _ = self._pending.pop(evaluation_id)
+                    optimizer.tell([x], [quality])
+                    num_told += 1
+                elif evaluation_id in self._expired:
+                    # late result of an evaluation which was told as failed already
+                    x, index = self._expired.pop(evaluation_id)
+                    optimizer.tell([x], [quality], history_indices=[index])
+            except Empty:
+                pass
+
+            now = time.time()
+            for evaluation_id, (x, start_time) in list(self._pending.items()):
+                if now - start_time > self._timeout:
+                    self._pending.pop(evaluation_id)
+                    self._expired[evaluation_id] = (x, optimizer.tell([x], [None])[0])
+                    num_told += 1
+
+        return optimizer.get_best_result()
+
+    def _send(self, x):
+        self._counter += 1
+        parameters = self._optimizer.get_all_numeric_parameters_for(x)
+        self._task_queue.put((self._problem_filename, self._counter, [float(p) for p in parameters]))
+        self._pending[self._counter] = (x, time.time())
+
+    def stop_workers(self, num_workers):
+        """
+        Asks the given number of workers to stop after their current evaluation.
+        """
+        for _ in range(num_workers):
+            self._task_queue.put(None)
+
+    def close(self):
+        """
+        Removes the problem file.
+        """
+        if os.path.exists(self._problem_filename):
+            os.remove(self._problem_filename)
+
+
+def run_worker(task_queue, result_queue):
+    """
+    Evaluates tasks sent by a Broker until None is received. Problems are loaded once and kept.
+    Results are sent as tuples of problem file name, evaluation id and quality.
+    """
+    problems = {}
+    while True:
+        task = task_queue.get()
+        if task is None:
+            return
+        problem_filename, evaluation_id, parameters = task
+        try:
+            if problem_filename not in problems:
+                with open(problem_filename, "rb") as file:
+                    problems[problem_filename] = pickle.load(file)
+            optimizer, target_task, annotation = problems[problem_filename]
+            optimizer.set_all_numeric_parameters(parameters)
+            quality = float(optimizer._fitness(optimizer._workflow.get(target_task), annotation))
+        except Exception:
+            quality = None
+        result_queue.put((problem_filename, evaluation_id, quality))
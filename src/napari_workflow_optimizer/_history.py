@@ -0,0 +1,190 @@
+import numpy as np
+
+
+class EvaluationHistory():
+    """
+    Columnar storage of all evaluations executed during an optimization.
+
+    Every evaluation of the objective function is stored as one row consisting of the parameter vector,
+    the measured quality, the time it took, and flags telling whether the result was taken from the cache,
+    whether the workflow failed, or whether the workflow produced an image that was evaluated before.
+    Rows which correspond to finished iterations of the optimizer are marked with their iteration number.
+    Columns are stored in preallocated numpy arrays which grow on demand.
+    """
+    def __init__(self, parameter_names, capacity=128):
+        self._parameter_names = list(parameter_names)
+        self._length = 0
+        self._best_index = -1
+        self._num_iterations = 0
+        self._parameters = np.zeros((capacity, len(self._parameter_names)))
+        self._quality = np.zeros(capacity)
+        self._duration = np.zeros(capacity)
+        self._cache_hit = np.zeros(capacity, dtype=bool)
+        self._failed = np.zeros(capacity, dtype=bool)
+        self._duplicate = np.zeros(capacity, dtype=bool)
+        self._iteration = np.zeros(capacity, dtype=int)
+
+    def __len__(self):
+        return self._length
+
+    def _grow(self):
+        capacity = max(1, 2 * len(self._quality))
+
+        def grown(array):
+            result = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+            result[:len(array)] = array
+            return result
+
+        self._parameters = grown(self._parameters)
+        self._quality = grown(self._quality)
+        self._duration = grown(self._duration)
+        self._cache_hit = grown(self._cache_hit)
+        self._failed = grown(self._failed)
+        self._duplicate = grown(self._duplicate)
+        self._iteration = grown(self._iteration)
+
+    def append(self, parameters, quality, duration=0, cache_hit=False, failed=False, duplicate=False):
+        """
+        Stores one evaluation. The quality of failed evaluations is stored as NaN.
+        """
+        if self._length == len(self._quality):
+            self._grow()
+        index = self._length
+        if failed:
+            quality = np.nan
+        self._parameters[index] = parameters
+        self._quality[index] = quality
+        self._duration[index] = duration
+        self._cache_hit[index] = cache_hit
+        self._failed[index] = failed
+        self._duplicate[index] = duplicate
+        self._iteration[index] = 0
+        if not failed and (self._best_index < 0 or quality > self._quality[self._best_index]):
+            self._best_index = index
+        self._length = index + 1
+
+    def replace(self, index, quality, failed=False):
+        """
+        Overwrites the quality of a stored evaluation, e.g. one stored as failed whose result arrived late.
+        """
+        was_best = index == self._best_index
+        self._quality[index] = np.nan if failed else quality
+        self._failed[index] = failed
+        if was_best:
+            valid = ~self._failed[:self._length]
+            self._best_index = int(np.flatnonzero(valid)[np.argmax(self._quality[:self._length][valid])]) \
+                if valid.any() else -1
+        elif not failed and (self._best_index < 0 or quality > self._quality[self._best_index]):
+            self._best_index = index
+
+    def mark_iteration(self):
+        """
+        Marks the last stored evaluation as result of the next iteration of the optimizer.
+        """
+        self._num_iterations += 1
+        self._iteration[self._length - 1] = self._num_iterations
+
+    @property
+    def parameter_names(self):
+        return self._parameter_names
+
+    @property
+    def parameters(self):
+        return self._parameters[:self._length]
+
+    @property
+    def quality(self):
+        return self._quality[:self._length]
+
+    @property
+    def duration(self):
+        return self._duration[:self._length]
+
+    @property
+    def cache_hit(self):
+        return self._cache_hit[:self._length]
+
+    @property
+    def failed(self):
+        return self._failed[:self._length]
+
+    @property
+    def duplicate(self):
+        return self._duplicate[:self._length]
+
+    @property
+    def iteration(self):
+        return self._iteration[:self._length]
+
+    def get_iterations(self):
+        """
+        Returns iteration numbers and corresponding quality of all evaluations which finished an iteration.
+        """
+        length = self._length
+        iteration = self._iteration[:length]
+        is_iteration = iteration > 0
+        return iteration[is_iteration], self._quality[:length][is_iteration]
+
+    def get_best_index(self):
+        """
+        Returns the index of the evaluation with the highest quality or -1 if there is none.
+        """
+        return self._best_index
+
+    def get_best_parameters(self):
+        """
+        Returns the parameter vector of the evaluation with the highest quality or None if there is none.
+        """
+        if self._best_index < 0:
+            return None
+        return self._parameters[self._best_index].copy()
+
+    def get_max_quality(self):
+        """
+        Returns the highest quality measured so far or None if there is none.
+        """
+        if self._best_index < 0:
+            return None
+        return self._quality[self._best_index]
+
+    def to_dict(self):
+        """
+        Returns all evaluations as dictionary of columns. Every parameter becomes a separate column.
+        """
+        result = {}
+        for i, name in enumerate(self._parameter_names):
+            result[name] = self.parameters[:, i]
+        result["quality"] = self.quality
+        result["duration"] = self.duration
+        result["cache_hit"] = self.cache_hit
+        result["failed"] = self.failed
+        result["duplicate"] = self.duplicate
+        result["iteration"] = self.iteration
+        return result
+
+    def to_dataframe(self):
+        """
+        Returns all evaluations as pandas DataFrame.
+        """
+        import pandas as pd
+        return pd.DataFrame(self.to_dict())
+
+    def save(self, filename):
+        """
+        Saves all evaluations to disk. The format is determined by the file ending:
+        .csv, .npz or .parquet (requires pandas and pyarrow).
+        """
+        filename = str(filename)
+        if filename.endswith(".npz"):
+            np.savez(filename, parameter_names=np.asarray(self._parameter_names, dtype=str),
+                     parameters=self.parameters, quality=self.quality, duration=self.duration,
+                     cache_hit=self.cache_hit, failed=self.failed, duplicate=self.duplicate,
+                     iteration=self.iteration)
+        elif filename.endswith(".csv"):
+            columns = self.to_dict()
+            data = np.stack([np.asarray(column, dtype=float) for column in columns.values()], axis=1)
+            np.savetxt(filename, data, delimiter=",", header=",".join(columns.keys()), comments="")
+        elif filename.endswith(".parquet"):
+            self.to_dataframe().to_parquet(filename)
+        else:
+            raise ValueError("Unsupported file format: " + filename)
@@ -0,0 +1,419 @@
+from threading import Condition, Lock
+
+import numpy as np
+from napari_workflows import Workflow
+
+from ._optimizer import JaccardLabelImageOptimizer, _PrecomputedWorkflow, annotated_timepoints, \
+    output_fingerprint, timepoint_workflow
+
+
+class OptimizationJob():
+    """
+    Describes one optimization to be run by a JobQueue.
+
+    Parameters
+    ----------
+    target_task: str
+        The layer/task name which should be optimized
+    annotation: ndarray
+        Reference image
+    free_parameters: list of int, optional
+        Indices of the numeric parameters to optimize, as listed by Optimizer.get_all_numeric_parameter_names().
+        By default, all numeric parameters are optimized.
+    optimizer_class: class, optional
+        Optimizer determining the fitness, by default the one of the JobQueue
+    optimizer: Optimizer, optional
+        Configured optimizer, e.g. with a mask, whose settings are used for the job instead of optimizer_class.
+        Its workflow is not modified.
+    strategy: str
+        "nelder-mead" runs Optimizer.optimize(), "evolution" runs the ask/tell evolution strategy
+    budget: int
+        Number of iterations for "nelder-mead" or number of evaluations for "evolution"
+    memory: int, optional
+        Memory in bytes the job needs. By default, it is estimated from the images in the workflow.
+    optimize_kwargs:
+        Further parameters passed to Optimizer.optimize(). The "evolution" strategy only uses timelapse.
+    """
+    def __init__(self, target_task, annotation, free_parameters=None, optimizer_class=None, optimizer=None,
+                 strategy="nelder-mead", budget=100, memory=None, **optimize_kwargs):
+        if strategy not in ["nelder-mead", "evolution"]:
+            raise ValueError("Unknown strategy: " + str(strategy))
+        self.target_task = target_task
+        self.annotation = annotation
+        self.free_parameters = free_parameters
+        self.optimizer_class = optimizer_class
+        self.optimizer = optimizer
+        self.strategy = strategy
+        self.budget = budget
+        self.memory = memory
+        self.optimize_kwargs = optimize_kwargs
+
+        self.status = "queued"
+        self.error = None
+        self._result = None
+        self._optimizer = None
+        self._undo_parameters = None
+        self._canceling = False
+        self._queue = None
+        self._intermediate_results = []
+        self._parameter_locations = []
+
+    def get_progress(self):
+        """
+        Returns the number of finished iterations (nelder-mead) or evaluations (evolution) and the budget.
+        """
+        if self._optimizer is None or self._optimizer.get_history() is None:
+            return 0, self.budget
+        if self.strategy == "nelder-mead":
+            iterations, _ = self._optimizer.get_plot()
+            return len(iterations), self.budget
+        return len(self._optimizer.get_history()), self.budget
+
+    def get_optimizer(self):
+        """
+        Returns the optimizer working on the job's copy of the workflow, e.g. to access its history.
+        """
+        return self._optimizer
+
+    def get_result(self):
+        """
+        Returns all numeric parameters of the workflow, including the constants, with the best setting found,
+        or None if the job did not finish.
+        """
+        return self._result
+
+    def get_undo_parameters(self):
+        """
+        Returns all numeric parameters of the workflow at the time the job was submitted.
+        """
+        return self._undo_parameters
+
+    def is_done(self):
+        return self.status in ["finished", "failed", "cancelled"]
+
+    def cancel(self):
+        """
+        Removes a queued job from the queue or stops a running job. A stopped job keeps its best result so far.
+        """
+        if self.is_done():
+            return
+        self._canceling = True
+        if self._queue is not None:
+            self._queue._remove_queued(self)
+        if self._optimizer is not None:
+            self._optimizer.cancel()
+
+
+class JobQueue():
+    """
+    Runs optimization jobs on copies of a workflow in a pool of worker threads.
+
+    At most max_concurrent jobs run at the same time, and jobs only start if their memory estimate fits
+    into memory_budget next to the running jobs. Jobs start in the order they were submitted.
+    Intermediate results of tasks which have no free parameters in a job are computed once and shared
+    between all jobs with the same upstream tasks. They are kept as long as a queued or running job needs
+    them and count against memory_budget.
+
+    Jobs use a copy of the given optimizer, including its settings such as a mask, or a new optimizer of
+    optimizer_class if no optimizer is given.
+    """
+    def __init__(self, workflow: Workflow, optimizer_class=JaccardLabelImageOptimizer, max_concurrent: int = 1,
+                 memory_budget: int = None, optimizer=None):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._workflow = workflow
+        self._optimizer_class = optimizer_class
+        self._optimizer = optimizer
+        self._max_concurrent = max_concurrent
+        self._memory_budget = memory_budget
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent)
+
+        self._jobs = []
+        self._queued = []
+        self._running = []
+        self._memory_in_use = 0
+        self._lock = Lock()
+        self._done = Condition(self._lock)
+
+        # task key -> result, its size in bytes, and the queued or running jobs which need it
+        self._intermediate_results = {}
+        self._intermediate_result_sizes = {}
+        self._intermediate_result_users = {}
+        self._intermediate_result_locks = {}
+        self.intermediate_result_hits = 0
+
+    def submit(self, job: OptimizationJob):
+        """
+        Adds a job to the queue. The job works on a copy of the workflow as it is at the time of submission.
+        """
+        job._workflow = _PrecomputedWorkflow(self._workflow)
+        if job.optimizer is not None:
+            job._optimizer = job.optimizer._copy_for(job._workflow)
+        elif job.optimizer_class is not None:
+            job._optimizer = job.optimizer_class(job._workflow)
+        elif self._optimizer is not None:
+            job._optimizer = self._optimizer._copy_for(job._workflow)
+        else:
+            job._optimizer = self._optimizer_class(job._workflow)
+        job._undo_parameters = job._optimizer.get_all_numeric_parameters()
+        # results are written back by task name and parameter position, as other tasks may be added meanwhile
+        job._parameter_locations = [(name, index, job._workflow.get_task(name)[0])
+                                    for name, index in job._optimizer._numeric_parameter_indices]
+        # a cancel before optimize() started, e.g. while intermediate results are computed, is not lost
+        job._optimizer._cancel_requested = lambda: job._canceling
+        for i in range(job._optimizer.total_number_of_parameters()):
+            if job.free_parameters is None or i in job.free_parameters:
+                job._optimizer.free_parameter(i)
+            else:
+                job._optimizer.fix_parameter(i)
+        if job.memory is None:
+            job.memory = estimate_memory(job._workflow)
+        # time-lapse jobs evaluate single time points, so results are shared per annotated time point
+        timepoints = annotated_timepoints(job.annotation) if job.optimize_kwargs.get("timelapse") else [None]
+        job._intermediate_results = []
+        for name in _constant_sources(job._workflow, job._optimizer, job.target_task):
+            key = _task_key(job._workflow._tasks, name)
+            job._intermediate_results += [(name, key if t is None else (key, t), t) for t in timepoints]
+
+        with self._lock:
+            for _, key, _ in job._intermediate_results:
+                self._intermediate_result_users.setdefault(key, set()).add(job)
+            job._queue = self
+            self._jobs.append(job)
+            self._queued.append(job)
+            self._dispatch()
+        return job
+
+    def get_jobs(self):
+        """
+        Returns all submitted jobs.
+        """
+        return list(self._jobs)
+
+    def wait(self, timeout=None):
+        """
+        Blocks until all submitted jobs are done. Returns False if the timeout (in seconds) expired before.
+        """
+        with self._done:
+            return self._done.wait_for(lambda: all(job.is_done() for job in self._jobs), timeout)
+
+    def apply(self, job: OptimizationJob):
+        """
+        Writes the result of a finished job into the workflow. Raises a ValueError if a task the job optimized
+        was removed or changed its function since the job was submitted.
+        """
+        self._write_parameters(job, job.get_result())
+
+    def undo(self, job: OptimizationJob):
+        """
+        Writes the parameters the workflow had when the job was submitted back into the workflow.
+        """
+        self._write_parameters(job, job.get_undo_parameters())
+
+    def _write_parameters(self, job: OptimizationJob, values):
+        workflow = self._workflow
+        for name, index, function in job._parameter_locations:
+            task = workflow._tasks.get(name)
+            if not (isinstance(task, tuple) and len(task) > index and task[0] is function and
+                    isinstance(task[index], (int, float))):
+                raise ValueError("The workflow changed since the job was submitted: " + name)
+        for (name, index, _), value in zip(job._parameter_locations, values):
+            task = list(workflow.get_task(name))
+            task[index] = value
+            workflow.set_task(name, tuple(task))
+
+    def shutdown(self):
+        """
+        Cancels all jobs and stops the worker threads.
+        """
+        for job in self._jobs:
+            job.cancel()
+        self._executor.shutdown()
+
+    def _remove_queued(self, job: OptimizationJob):
+        with self._lock:
+            if job in self._queued:
+                self._queued.remove(job)
+                self._release_intermediate_results(job)
+                job.status = "cancelled"
+                self._done.notify_all()
+                self._dispatch()
+
+    def _dispatch(self):
+        # must be called while holding self._lock
+        while len(self._queued) > 0 and len(self._running) < self._max_concurrent:
+            job = self._queued[0]
+            if self._memory_budget is not None and len(self._running) > 0 and \
+                    self._memory_in_use + job.memory > self._memory_budget:
+                return
+            self._queued.pop(0)
+            self._running.append(job)
+            self._memory_in_use += job.memory
+            job.status = "running"
+            self._executor.submit(self._run, job)
+
+    def _run(self, job: OptimizationJob):
+        status = "cancelled"
+        try:
+            if not job._canceling:
+                self._share_intermediate_results(job)
+            # the job may have been cancelled while intermediate results were computed
+            if not job._canceling:
+                optimizer = job._optimizer
+                if job.strategy == "nelder-mead":
+                    x = optimizer.optimize(job.target_task, job.annotation, maxiter=job.budget,
+                                           **job.optimize_kwargs)
+                else:
+                    x = self._run_evolution(job)
+                job._result = optimizer.get_all_numeric_parameters_for(x)
+                status = "cancelled" if job._canceling else "finished"
+        except Exception as e:
+            job.error = e
+            status = "failed"
+        finally:
+            with self._lock:
+                self._running.remove(job)
+                self._memory_in_use -= job.memory
+                job._workflow._precomputed.clear()
+                job._workflow._timepoint_precomputed.clear()
+                self._release_intermediate_results(job)
+                # set last, so that waiting for the job includes releasing its memory
+                job.status = status
+                self._done.notify_all()
+                self._dispatch()
+
+    def _run_evolution(self, job: OptimizationJob):
+        optimizer = job._optimizer
+        optimizer.reset_ask_tell()
+        x0 = optimizer.get_numeric_parameters()
+        timepoints = annotated_timepoints(job.annotation) if job.optimize_kwargs.get("timelapse") else None
+
+        def fitness():
+            if timepoints is None:
+                return optimizer._fitness(job._workflow.get(job.target_task), job.annotation)
+            return np.mean([optimizer._timepoint_fitness(timepoint_workflow(job._workflow, t).get(job.target_task),
+                                                         job.annotation, t) for t in timepoints])
+
+        num_evaluations = 0
+        while num_evaluations < job.budget and not job._canceling:
+            candidates = optimizer.ask(min(4, job.budget - num_evaluations))
+            qualities = []
+            for x in candidates:
+                optimizer.set_numeric_parameters(x)
+                try:
+                    qualities.append(fitness())
+                except Exception:
+                    qualities.append(None)
+            optimizer.tell(candidates, qualities)
+            num_evaluations += len(candidates)
+        optimizer.set_numeric_parameters(x0)
+        return optimizer.get_best_result()
+
+    def _share_intermediate_results(self, job: OptimizationJob):
+        """
+        Looks up or computes the results of all tasks the target depends on which have no free parameters.
+        Only jobs needing the same result wait for each other.
+        """
+        workflow = job._workflow
+        for name, key, t in job._intermediate_results:
+            with self._lock:
+                key_lock = self._intermediate_result_locks.setdefault(key, Lock())
+            with key_lock:
+                with self._lock:
+                    found = key in self._intermediate_results
+                    if found:
+                        self.intermediate_result_hits += 1
+                        result = self._intermediate_results[key]
+                if not found:
+                    result = workflow.get(name) if t is None else timepoint_workflow(workflow, t).get(name)
+                    with self._lock:
+                        self._intermediate_results[key] = result
+                        self._intermediate_result_sizes[key] = int(getattr(result, "nbytes", 0))
+                        self._memory_in_use += self._intermediate_result_sizes[key]
+            if t is None:
+                workflow._precomputed[name] = result
+            else:
+                workflow._timepoint_precomputed.setdefault(t, {})[name] = result
+
+    def _release_intermediate_results(self, job: OptimizationJob):
+        # must be called while holding self._lock
+        for _, key, _ in job._intermediate_results:
+            users = self._intermediate_result_users.get(key)
+            if users is None:
+                continue
+            users.discard(job)
+            if len(users) == 0:
+                del self._intermediate_result_users[key]
+                self._intermediate_result_locks.pop(key, None)
+                if key in self._intermediate_results:
+                    del self._intermediate_results[key]
+                    self._memory_in_use -= self._intermediate_result_sizes.pop(key)
+
+
+def _constant_sources(workflow: Workflow, optimizer, target_task):
+    """
+    Returns the names of computed tasks the target depends on which have no free numeric parameter and only
+    depend on such tasks. Only the last of such tasks on every path to the target are listed.
+    """
+    free_tasks = set([name for i, [name, _] in enumerate(optimizer._numeric_parameter_indices)
+                      if optimizer._fixed_parameters[i] == 0])
+    constant = {}
+
+    def is_constant(name):
+        if name not in constant:
+            task = workflow._tasks[name]
+            if not (isinstance(task, tuple) and callable(task[0])):
+                constant[name] = True
+            else:
+                constant[name] = name not in free_tasks and all(
+                    is_constant(source) for source in workflow.sources_of(name) if source in workflow._tasks)
+        return constant[name]
+
+    result = []
+
+    def collect(name):
+        task = workflow._tasks[name]
+        if not (isinstance(task, tuple) and callable(task[0])):
+            return
+        if is_constant(name):
+            if name not in result:
+                result.append(name)
+        else:
+            for source in workflow.sources_of(name):
+                if source in workflow._tasks:
+                    collect(source)
+
+    collect(target_task)
+    return result
+
+
+def _task_key(tasks, name):
+    """
+    Returns a hashable description of a task including all tasks it depends on. Images are identified by
+    their content.
+    """
+    task = tasks[name]
+    if not (isinstance(task, tuple) and callable(task[0])):
+        return output_fingerprint(task)
+    key = [task[0]]
+    for argument in task[1:]:
+        if isinstance(argument, str) and argument in tasks:
+            key.append(_task_key(tasks, argument))
+        elif hasattr(argument, "shape") and hasattr(argument, "dtype"):
+            key.append(output_fingerprint(argument))
+        elif "napari.viewer.Viewer" in str(type(argument)):
+            key.append(id(argument))
+        else:
+            key.append(argument)
+    return tuple(key)
+
+
+def estimate_memory(workflow: Workflow):
+    """
+    Roughly estimates the memory in bytes an optimization of a workflow needs: all input images plus one
+    image of the size of the largest input image per computed task.
+    """
+    images = [task for task in workflow._tasks.values() if hasattr(task, "nbytes")]
+    largest = max([image.nbytes for image in images], default=0)
+    num_computed = len([task for task in workflow._tasks.values() if isinstance(task, tuple) and callable(task[0])])
+    return int(np.sum([image.nbytes for image in images]) + num_computed * largest)
@@ -1,16 +1,36 @@
 from napari_workflows import Workflow
 from scipy.optimize import minimize
 import numpy as np
+from ._history import EvaluationHistory
 
 class Optimizer():
     def __init__(self, workflow: Workflow):
+        from threading import Lock
         self._workflow = workflow
         self._numeric_parameter_indices = self._find_numeric_parameters()
         self._fixed_parameters = np.zeros((len(self._numeric_parameter_indices)))
-        self._iteration = None
-        self._quality = None
+        self._history = None
+        self._strategy = None
+        self._buffer_pool = None
+        self._stop_reason = None
         self._running = False
         self._canceling = False
+        self._cancel_reason = "cancelled"
+        self._cancel_lock = Lock()
+        # optional function telling if the owner of the optimizer, e.g. a queued job, was cancelled
+        self._cancel_requested = None
+
+    def __getstate__(self):
+        # locks cannot be sent to other processes
+        state = self.__dict__.copy()
+        del state["_cancel_lock"]
+        state["_cancel_requested"] = None
+        return state
+
+    def __setstate__(self, state):
+        from threading import Lock
+        self.__dict__.update(state)
+        self._cancel_lock = Lock()
 
     def _find_numeric_parameters(self):
         """
@@ -36,6 +56,17 @@ class Optimizer():
                 result.append(self._workflow.get_task(name)[index])
         return result
 
+    def get_numeric_parameter_names(self):
+        """
+        Returns the names of all non-constant numeric parameters of the workflow as strings
+        consisting of layer name and parameter name.
+        """
+        result = []
+        for parameter_index, [layer_name, parameter_name] in enumerate(self.get_all_numeric_parameter_names()):
+            if self._fixed_parameters[parameter_index] == 0:
+                result.append(layer_name + " " + parameter_name)
+        return result
+
     def set_numeric_parameters(self, x):
         """
         Overwrites all non-constant numeric parameters of the workflow with a given list of numbers x.
@@ -105,7 +136,142 @@ class Optimizer():
         """
         self._fixed_parameters[index] = 0
 
-    def optimize(self, target_task, annotation, maxiter = 100, debug_output = False):
+    def analyse_sensitivity(self, target_task, annotation, relative_step = 0.1, num_workers = 2,
+                            fix_insensitive = False, threshold = 0, timelapse = False):
+        """
+        Determines how much the quality changes when varying the non-constant numeric parameters one at a time.
+        Each parameter is increased and decreased by relative_step times its value, while all other parameters
+        stay at their current values. All parameter sets are evaluated in parallel on copies of the workflow.
+
+        Parameters
+        ----------
+        target_task: str
+            The layer/task name which should be optimized
+        annotation: ndarry
+            Reference image
+        relative_step: float or list of float
+            Relative change of each parameter. Parameters with value 0 are changed by relative_step.
+            If several steps are given, every parameter is varied by each of them. This helps detecting
+            parameters whose small variations stay on a plateau of the quality landscape.
+        num_workers: int
+            Number of parameter sets which are evaluated in parallel
+        fix_insensitive: bool
+            If set to true, parameters with sensitivity <= threshold become constants for the optimization
+        threshold: float
+            Maximum sensitivity of a parameter which is considered insensitive
+        timelapse: bool
+            If set to true, annotation is a 4D (t, z, y, x) reference image and the mean quality over the
+            annotated time points is measured, as in optimize().
+
+        Returns
+        -------
+        List of sensitivities for all numeric parameters in the workflow, including the constants.
+        The sensitivity is the maximum absolute quality change caused by the parameter. Constants
+        have sensitivity NaN. In case the workflow fails for a variation, the sensitivity is infinite.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        relative_steps = np.atleast_1d(relative_step)
+        if timelapse:
+            timepoints = annotated_timepoints(annotation)
+            if len(timepoints) == 0:
+                raise ValueError("The reference image does not contain annotations in any time point.")
+
+        x0 = self.get_all_numeric_parameters()
+        free_indices = [i for i in range(len(x0)) if self._fixed_parameters[i] == 0]
+
+        parameter_sets = [x0]
+        for i in free_indices:
+            for relative in relative_steps:
+                step = abs(x0[i]) * relative if x0[i] != 0 else relative
+                for direction in [1, -1]:
+                    x = list(x0)
+                    x[i] = x0[i] + direction * step
+                    parameter_sets.append(x)
+
+        def evaluate(x):
+            try:
+                workflow = self._workflow_with_parameters(x)
+                if timelapse:
+                    return np.mean([self._timepoint_fitness(timepoint_workflow(workflow, t).get(target_task),
+                                                            annotation, t) for t in timepoints])
+                return self._fitness(workflow.get(target_task), annotation)
+            except:
+                return np.nan
+
+        self._clear_caches()
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, num_workers)) as executor:
+                qualities = list(executor.map(evaluate, parameter_sets))
+        finally:
+            self._clear_caches()
+
+        num_variations = 2 * len(relative_steps)
+        sensitivities = np.full(len(x0), np.nan)
+        for n, i in enumerate(free_indices):
+            variations = qualities[1 + num_variations * n: 1 + num_variations * (n + 1)]
+            differences = np.abs(np.asarray(variations) - qualities[0])
+            sensitivities[i] = np.inf if np.any(np.isnan(differences)) else differences.max()
+
+        if fix_insensitive:
+            for i in free_indices:
+                if sensitivities[i] <= threshold:
+                    self.fix_parameter(i)
+
+        return sensitivities
+
+    def _clear_caches(self):
+        """
+        Forgets data kept between evaluations, e.g. converted reference images. Called at the start and end of
+        every run, so that images edited in place between runs are not used in their old state.
+        """
+        pass
+
+    def _copy_for(self, workflow: Workflow):
+        """
+        Returns a copy of the optimizer with the same settings, e.g. constant parameters or a mask, working on
+        a given workflow with the same tasks. The state of past optimizations is not copied.
+        """
+        import copy
+        from threading import Lock
+        result = copy.copy(self)
+        result._workflow = workflow
+        result._fixed_parameters = self._fixed_parameters.copy()
+        result._history = None
+        result._strategy = None
+        result._buffer_pool = None
+        result._stop_reason = None
+        result._running = False
+        result._canceling = False
+        result._cancel_reason = "cancelled"
+        result._cancel_requested = None
+        result._cancel_lock = Lock()
+        return result
+
+    def _timepoint_fitness(self, test, annotation, t):
+        """
+        Determine the quality of a given test image of time point t compared to a 4D reference image.
+        """
+        return self._fitness(test, timepoint_data(annotation, t))
+
+    def _workflow_with_parameters(self, x):
+        """
+        Returns a shallow copy of the workflow where all numeric parameters, including the constants,
+        are replaced by a given list of numbers x. The workflow of the optimizer is not modified.
+        """
+        workflow = _empty_copy(self._workflow)
+        for name, task in self._workflow._tasks.items():
+            workflow.set_task(name, task)
+        for [name, index], value in zip(self._numeric_parameter_indices, x):
+            task = list(workflow.get_task(name))
+            task[index] = value
+            workflow.set_task(name, tuple(task))
+        return workflow
+
+    def optimize(self, target_task, annotation, maxiter = 100, debug_output = False, timelapse = False, num_workers = 2,
+                 evaluate_in_process = False, skip_duplicate_outputs = True, reuse_output_buffers = False,
+                 max_evaluations = None, max_time = None, target_quality = None, patience = None,
+                 min_improvement = 0):
         """
         Optimizes the given workflow.
 
@@ -119,26 +285,143 @@ class Optimizer():
             Number of iterations
         debug_output: bool
             If set to true, every attempt will be prompted to stdout
+        timelapse: bool
+            If set to true, annotation is a 4D (t, z, y, x) reference image as used by napari-time-slicer.
+            Only annotated time points are computed and the mean quality over them is optimized.
+        num_workers: int
+            Number of time points which are processed in parallel in timelapse mode. This also limits
+            how many time points are held in memory at the same time.
+        evaluate_in_process: bool
+            If set to true, the workflow is executed in a separate worker process. When the optimization
+            is cancelled, this process is terminated so that a running evaluation is aborted immediately.
+            All functions in the workflow must be importable from that process.
+        skip_duplicate_outputs: bool
+            If set to true, a fingerprint of every computed target image is stored together with its quality.
+            If a parameter set produces an image that was evaluated before, e.g. on a plateau of the quality
+            landscape, the stored quality is used instead of computing it again.
+        reuse_output_buffers: bool
+            If set to true, the output images of the first evaluation are kept and passed as `destination` (or
+            `out`) to the functions in subsequent evaluations, instead of allocating new images every time.
+            Only use this if no optimized parameter changes the size or type of any output image.
+        max_evaluations: int, optional
+            Stop after the workflow was executed this number of times. Cached results are not counted.
+        max_time: float, optional
+            Stop after this number of seconds. The optimization is cancelled when the time is up. With
+            evaluate_in_process, a running evaluation is aborted; otherwise it is finished first.
+        target_quality: float, optional
+            Stop as soon as this quality is reached.
+        patience: int, optional
+            Stop if the best quality did not improve by more than min_improvement within the last
+            patience workflow executions, e.g. on a plateau of the quality landscape.
+        min_improvement: float
+            Minimum improvement of quality which resets the patience counter.
 
         Returns
         -------
         List of numbers corresponding to the not-constant numeric parameters of a given workflow.
+        In case the optimization was cancelled or stopped by a stopping rule, the best parameters evaluated
+        so far are returned. The rule which stopped the optimization can be retrieved using get_stop_reason().
         """
+        if timelapse and evaluate_in_process:
+            raise ValueError("Timelapse optimization cannot be combined with evaluation in a separate process.")
+
+        if timelapse:
+            timepoints = annotated_timepoints(annotation)
+            if len(timepoints) == 0:
+                raise ValueError("The reference image does not contain annotations in any time point.")
+
         method = 'nelder-mead'
+        self._clear_caches()
+        # a following ask() starts a new search with its own history
+        self._strategy = None
         self._counter = 0
-        self._iteration = []
-        self._quality = []
-        self._settings = []
-        self._running = True
-        self._canceling = False
+        self._history = EvaluationHistory(self.get_numeric_parameter_names())
+        self._stop_reason = None
+        with self._cancel_lock:
+            self._running = True
+            self._canceling = False
+            self._cancel_reason = "cancelled"
 
         from functools import lru_cache
+        import time
+
+        if evaluate_in_process:
+            process = _EvaluationProcess(self._workflow, target_task)
+
+        # output images are counted in any case, so that runs with and without reusing them can be compared
+        self._buffer_pool = None if evaluate_in_process else OutputBufferPool(reuse=reuse_output_buffers)
+
+        def evaluation_workflow(workflow, key=()):
+            if self._buffer_pool is None:
+                return workflow
+            return self._buffer_pool.workflow(workflow, key)
+
+        # fingerprint of target images -> fitness
+        output_qualities = {}
+
+        def output_fitness(test, t=None):
+            """
+            Returns the fitness of a given target image, optionally of time point t, and if it was looked up
+            by the image's fingerprint.
+            """
+            def fitness_of(test):
+                if t is None:
+                    return self._fitness(test, annotation)
+                return self._timepoint_fitness(test, annotation, t)
+
+            if not skip_duplicate_outputs:
+                return fitness_of(test), False
+            fingerprint = (() if t is None else (t,)) + output_fingerprint(test)
+            if fingerprint in output_qualities:
+                return output_qualities[fingerprint], True
+            fitness = fitness_of(test)
+            output_qualities[fingerprint] = fitness
+            return fitness, False
+
+        if timelapse:
+            from concurrent.futures import ThreadPoolExecutor
+            executor = ThreadPoolExecutor(max_workers=max(1, min(num_workers, len(timepoints))))
+
+            def timepoint_fitness(t):
+                test = evaluation_workflow(timepoint_workflow(self._workflow, t), (t,)).get(target_task)
+                return output_fitness(test, t)
+
+        # state of the stopping rules
+        progress = {"evaluations": 0, "last_improvement": 0, "reference_quality": None}
+
+        def check_stopping_rules():
+            """
+            Raises _StopOptimization if any of the configured stopping rules applies.
+            """
+            max_quality = self._history.get_max_quality()
+            if max_quality is not None and (progress["reference_quality"] is None or
+                                            max_quality > progress["reference_quality"] + min_improvement):
+                progress["reference_quality"] = max_quality
+                progress["last_improvement"] = progress["evaluations"]
+
+            if target_quality is not None and max_quality is not None and max_quality >= target_quality:
+                raise _StopOptimization("target_quality")
+            if max_evaluations is not None and progress["evaluations"] >= max_evaluations:
+                raise _StopOptimization("max_evaluations")
+            if patience is not None and progress["evaluations"] - progress["last_improvement"] >= patience:
+                raise _StopOptimization("no_improvement")
 
         def fun(x):
             """
-            Helper function to make num_fun lru-cachable.
+            Helper function to make num_fun lru-cachable. Every call is stored in the history
+            and the stopping rules are checked afterwards.
             """
-            return num_fun(*(x.tolist()))
+            hits = num_fun.cache_info().hits
+            start_time = time.perf_counter()
+            quality, failed, duplicate = num_fun(*(x.tolist()))
+            cache_hit = num_fun.cache_info().hits > hits
+            duration = 0 if cache_hit else time.perf_counter() - start_time
+            self._history.append(x, -quality, duration, cache_hit=cache_hit, failed=failed,
+                                 duplicate=duplicate and not cache_hit)
+            if not cache_hit:
+                progress["evaluations"] += 1
+            check_stopping_rules()
+            return quality
 
         @lru_cache(maxsize=10)
         def num_fun(*x):
@@ -152,31 +435,45 @@ class Optimizer():
 
             Returns
             -------
-            quality, metric depends on implementation
+            quality, metric depends on implementation, if the workflow failed, and if the
+            quality was looked up because the same target image was evaluated before
             """
             self._counter += 1
 
-            if len(self._quality) > 0 and self._canceling:
-                return np.max(self._quality)
+            if self.is_cancelling():
+                raise _StopOptimization(self._cancel_reason)
 
             # apply current parameter setting
             self.set_numeric_parameters(x)
             try:
-                test = self._workflow.get(target_task)
+                if timelapse:
+                    fitnesses, duplicates = zip(*executor.map(timepoint_fitness, timepoints))
+                    fitness = np.mean(fitnesses)
+                    duplicate = all(duplicates)
+                elif evaluate_in_process:
+                    test = process.evaluate(self.get_all_numeric_parameters(), self.is_cancelling)
+                else:
+                    test = evaluation_workflow(self._workflow).get(target_task)
+            except _StopOptimization:
+                raise
             except:
-                if len(self._quality) > 0:
-                    quality = np.max(self._quality)
+                max_quality = self._history.get_max_quality()
+                if max_quality is not None:
+                    quality = max_quality
                 else:
                     quality = np.finfo(float).max
-                return quality
+                return quality, True, False
+
+            if not timelapse:
+                fitness, duplicate = output_fitness(test)
 
             # as we are minimizing, we multiply fitness with -1
-            quality = -self._fitness(test, annotation)
+            quality = -fitness
 
             if debug_output:
                 print(self._counter, x, quality)
 
-            return quality
+            return quality, False, duplicate
 
         def progress_callback(x):
             """
@@ -184,44 +481,172 @@ class Optimizer():
             We then take the preliminary result and store it together with the
             corresponding quality.
             """
-            if not self._canceling:
-                quality = fun(x)
-                self._iteration.append(len(self._iteration) + 1)
-                self._quality.append(-quality)
-                self._settings.append(x)
+            if not self.is_cancelling():
+                fun(x)
+                self._history.mark_iteration()
 
         # starting point in parameter space
         x0 = self.get_numeric_parameters()
 
+        # the wall-clock budget cancels the optimization, so that also a running evaluation can be aborted
+        timer = None
+        if max_time is not None:
+            from threading import Timer
+            timer = Timer(max_time, self._cancel, args=("max_time",))
+            timer.daemon = True
+            timer.start()
+
         # run the optimization
         options = {
             'xatol': 1e-3,
             'disp': debug_output,
             'maxiter': maxiter}
-        res = minimize(fun, x0, method=method, callback=progress_callback, options=options)
+        try:
+            res = minimize(fun, x0, method=method, callback=progress_callback, options=options)
+            result = res['x']
+            self._stop_reason = {0: "converged", 1: "max_function_evaluations", 2: "maxiter"}.get(res['status'],
+                                                                                                  res['message'])
+        except _StopOptimization as stop:
+            self._stop_reason = self._cancel_reason if self.is_cancelling() else stop.reason
+            res = "Optimization stopped: " + self._stop_reason
+            result = self._history.get_best_parameters()
+            if result is None:
+                result = np.asarray(x0)
+        finally:
+            if timer is not None:
+                timer.cancel()
+            if timelapse:
+                executor.shutdown()
+            if evaluate_in_process:
+                process.terminate()
+            self.set_numeric_parameters(x0)
+            self._clear_caches()
+            with self._cancel_lock:
+                self._running = False
+                self._canceling = False
 
         # print and show result
         if debug_output:
             print(res)
-        self.set_numeric_parameters(x0)
 
-        self._running = False
-        self._canceling = False
+        return result
+
+    def ask(self, n = 1):
+        """
+        Proposes parameter sets to evaluate, e.g. on other machines, for optimizing the workflow step by step
+        instead of calling optimize(). The first call starts a new search from the current parameters.
 
-        return res['x']
+        Parameters
+        ----------
+        n: int
+            Number of parameter sets to return
+
+        Returns
+        -------
+        List of n parameter sets, each a list of numbers corresponding to the not-constant numeric parameters.
+        """
+        if self._strategy is None:
+            from ._ask_tell import AskTellStrategy
+            self._strategy = AskTellStrategy(self.get_numeric_parameters())
+            self._history = EvaluationHistory(self.get_numeric_parameter_names())
+        return self._strategy.ask(n)
+
+    def tell(self, vectors, qualities, history_indices = None):
+        """
+        Reports the measured quality of parameter sets previously returned by ask(). Results can be told in
+        any order or late. Failed evaluations are reported with quality None.
+
+        Parameters
+        ----------
+        vectors: list of parameter sets
+        qualities: list of numbers
+            Fitness of the parameter sets (higher is better), as measured by _fitness()
+        history_indices: list of int, optional
+            Rows of the history to overwrite instead of appending new ones, e.g. of evaluations which were
+            told as failed before their result arrived late.
+
+        Returns
+        -------
+        List of the history rows the results were stored in.
+        """
+        if self._strategy is None:
+            raise RuntimeError("tell() can only be called after ask() started a search.")
+        qualities = [np.nan if quality is None else quality for quality in qualities]
+        self._strategy.tell(vectors, qualities)
+        result = []
+        for n, (x, quality) in enumerate(zip(vectors, qualities)):
+            if history_indices is None:
+                result.append(len(self._history))
+                self._history.append(x, quality, failed=bool(np.isnan(quality)))
+            else:
+                result.append(history_indices[n])
+                self._history.replace(history_indices[n], quality, failed=bool(np.isnan(quality)))
+        return result
+
+    def reset_ask_tell(self):
+        """
+        Forgets the state of the ask/tell search, so that the next ask() starts from the current parameters.
+        """
+        self._strategy = None
+
+    def get_all_numeric_parameters_for(self, x):
+        """
+        Returns all numeric parameters of the workflow, including the constants, where the non-constant
+        parameters are replaced by a given list of numbers x.
+        """
+        result = self.get_all_numeric_parameters()
+        free_indices = [i for i in range(len(result)) if self._fixed_parameters[i] == 0]
+        for i, value in zip(free_indices, x):
+            result[i] = value
+        return result
 
     def get_plot(self):
         """
         Returns list of executed iterations numbers (a range) and corresponding measured quality values.
         """
-        return self._iteration, self._quality
+        if self._history is None:
+            return None, None
+        return self._history.get_iterations()
 
     def get_best_result(self):
         """
-        Goes through intermediate results and returns the parameter settings with the best quality so far.
+        Returns the parameter settings with the best quality evaluated so far.
         """
-        max_quality_index = np.argmax(self._quality)
-        return self._settings[max_quality_index]
+        return self._history.get_best_parameters()
+
+    def get_buffer_statistics(self):
+        """
+        Returns how often output images of functions with a `destination` or `out` parameter were allocated
+        and how often buffers were reused in the last optimization, as dictionary with keys "allocations" and
+        "reuses". Without reuse_output_buffers, every execution of such a function allocates an image.
+        Returns None before the first optimization and for optimizations with evaluate_in_process=True.
+        """
+        if self._buffer_pool is None:
+            return None
+        return {"allocations": self._buffer_pool.allocations, "reuses": self._buffer_pool.reuses}
+
+    def get_number_of_duplicate_outputs(self):
+        """
+        Returns how many evaluations of the last optimization produced a target image which was evaluated
+        before, typically because the parameters were on a plateau of the quality landscape.
+        """
+        if self._history is None:
+            return 0
+        return int(self._history.duplicate.sum())
+
+    def get_stop_reason(self):
+        """
+        Returns why the last optimization stopped: "converged", "maxiter" or "max_function_evaluations"
+        as determined by Nelder-Mead, "cancelled", or the name of the stopping rule: "max_evaluations",
+        "max_time", "target_quality" or "no_improvement".
+        """
+        return self._stop_reason
+
+    def get_history(self):
+        """
+        Returns the EvaluationHistory of the last optimization, containing every evaluated parameter set.
+        """
+        return self._history
 
     def is_running(self):
         """
@@ -232,14 +657,259 @@ class Optimizer():
     def cancel(self):
         """
         In case the optimizer is running, we can interrupt it by calling this function.
+        No further parameter sets are evaluated afterwards and optimize() returns the best result so far.
         """
-        self._canceling = True
+        self._cancel("cancelled")
+
+    def _cancel(self, reason):
+        with self._cancel_lock:
+            # e.g. a timer firing after the optimization finished must not cancel the next one
+            if not self._running:
+                return
+            if not self._canceling:
+                self._cancel_reason = reason
+                self._canceling = True
 
     def is_cancelling(self):
         """
         Returns if the optimizier is currently cancelling.
         """
-        return self._canceling
+        return self._canceling or (self._cancel_requested is not None and self._cancel_requested())
+
+class _StopOptimization(Exception):
+    """
+    Raised from within the objective function to leave the optimization loop, e.g. when the optimizer is
+    cancelled or a stopping rule applies. The reason is stored in the exception.
+    """
+    def __init__(self, reason="cancelled"):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class _EvaluationProcess():
+    """
+    Executes a workflow in a separate process which can be terminated while an evaluation is running.
+    The workflow is sent to the process once; for every evaluation only the numeric parameters are sent.
+    """
+    def __init__(self, workflow: Workflow, target_task):
+        import multiprocessing
+        # spawning instead of forking is necessary as forked processes cannot use the parent's OpenCL context
+        context = multiprocessing.get_context("spawn")
+        self._connection, child_connection = context.Pipe()
+        self._process = context.Process(target=_evaluation_process_loop,
+                                        args=(child_connection, without_viewer(workflow), target_task),
+                                        daemon=True)
+        self._process.start()
+
+    def evaluate(self, parameters, is_cancelling):
+        """
+        Computes the target task with the given numeric parameters (including constants) and returns it.
+        While waiting for the result, is_cancelling() is polled. If it returns true, the process is terminated.
+        """
+        self._connection.send(list(parameters))
+        while not self._connection.poll(0.01):
+            if is_cancelling():
+                self.terminate()
+                raise _StopOptimization()
+            if not self._process.is_alive():
+                raise RuntimeError("The evaluation process terminated unexpectedly.")
+        success, result = self._connection.recv()
+        if not success:
+            raise RuntimeError(result)
+        return result
+
+    def terminate(self):
+        if self._process.is_alive():
+            self._process.terminate()
+        self._process.join()
+
+
+def _evaluation_process_loop(connection, workflow, target_task):
+    optimizer = Optimizer(workflow)
+    while True:
+        try:
+            parameters = connection.recv()
+        except EOFError:
+            return
+        try:
+            optimizer.set_all_numeric_parameters(parameters)
+            connection.send((True, np.asarray(workflow.get(target_task))))
+        except Exception as e:
+            connection.send((False, repr(e)))
+
+
+class _PrecomputedWorkflow(Workflow):
+    """
+    Copy of a workflow where results of some tasks are given and do not need to be computed.
+    Results given per time point are used by the workflows returned by timepoint_workflow().
+    """
+    def __init__(self, workflow: Workflow = None, precomputed: dict = None, timepoint_precomputed: dict = None):
+        super().__init__()
+        if workflow is not None:
+            self._tasks = dict(workflow._tasks)
+        self._precomputed = {} if precomputed is None else precomputed
+        self._timepoint_precomputed = {} if timepoint_precomputed is None else timepoint_precomputed
+
+    def get(self, name):
+        if name in self._precomputed:
+            return self._precomputed[name]
+        from dask.threaded import get as dask_get
+        tasks = dict(self._tasks)
+        tasks.update(self._precomputed)
+        return dask_get(tasks, name)
+
+
+def _empty_copy(workflow: Workflow, t=None):
+    """
+    Returns a workflow without tasks which keeps the precomputed results of the given workflow, if any.
+    If a time point t is given, the results precomputed for this time point are kept instead.
+    """
+    if not isinstance(workflow, _PrecomputedWorkflow):
+        return Workflow()
+    if t is None:
+        return _PrecomputedWorkflow(precomputed=workflow._precomputed,
+                                    timepoint_precomputed=workflow._timepoint_precomputed)
+    return _PrecomputedWorkflow(precomputed=workflow._timepoint_precomputed.get(t, {}))
+
+
+def without_viewer(workflow: Workflow):
+    """
+    Returns a shallow copy of the given workflow where references to a napari viewer are removed.
+    Precomputed results are converted to numpy arrays, so that the copy can be sent to another process.
+    """
+    result = _empty_copy(workflow)
+    if isinstance(result, _PrecomputedWorkflow):
+        result._precomputed = {name: np.asarray(data) for name, data in result._precomputed.items()}
+        result._timepoint_precomputed = {t: {name: np.asarray(data) for name, data in results.items()}
+                                         for t, results in result._timepoint_precomputed.items()}
+    for name, task in workflow._tasks.items():
+        if isinstance(task, tuple) and callable(task[0]):
+            task = tuple([task[0]] + [None if _is_viewer(argument) else argument for argument in task[1:]])
+        result.set_task(name, task)
+    return result
+
+
+class OutputBufferPool():
+    """
+    Keeps the output image of every workflow task which has a `destination` or `out` parameter and passes
+    it to the function when the task is executed again, so that no new image needs to be allocated.
+    If reuse is False, output images are only counted.
+    """
+    def __init__(self, reuse: bool = True):
+        from threading import Lock
+        self._reuse = reuse
+        self._buffers = {}
+        self._lock = Lock()
+        self.allocations = 0
+        self.reuses = 0
+
+    def workflow(self, workflow: Workflow, key=()):
+        """
+        Returns a shallow copy of the given workflow where functions receive buffers from the pool.
+        Buffers are identified by the task name and an optional key, e.g. a time point.
+        """
+        result = _empty_copy(workflow)
+        for name, task in workflow._tasks.items():
+            if isinstance(task, tuple) and callable(task[0]):
+                index = _destination_index(task[0])
+                # workflows omit trailing None parameters
+                if index is not None and (index >= len(task) or task[index] is None):
+                    task = (self._buffered(task[0], index - 1, key + (name,)),) + task[1:]
+            result.set_task(name, task)
+        return result
+
+    def _buffered(self, function, position, key):
+        def buffered_function(*args):
+            buffer = self._buffers.get(key)
+            if buffer is not None:
+                args = list(args) + [None] * (position + 1 - len(args))
+                args[position] = buffer
+            result = function(*args)
+            with self._lock:
+                if buffer is not None and result is buffer:
+                    self.reuses += 1
+                else:
+                    self.allocations += 1
+                    if self._reuse:
+                        self._buffers[key] = result
+            return result
+        return buffered_function
+
+
+def _destination_index(function):
+    """
+    Returns the index of the `destination` or `out` parameter of a function in a workflow task tuple or None.
+    """
+    import inspect
+    try:
+        parameters = inspect.signature(function).parameters.values()
+    except (TypeError, ValueError):
+        return None
+    for i, parameter in enumerate(parameters):
+        if parameter.name in ["destination", "out"] and \
+                parameter.kind in [parameter.POSITIONAL_ONLY, parameter.POSITIONAL_OR_KEYWORD]:
+            return i + 1
+    return None
+
+
+def output_fingerprint(data):
+    """
+    Returns a tuple identifying the content of a given image: shape, type and a fast hash over the pixels.
+    """
+    import hashlib
+    data = np.ascontiguousarray(np.asarray(data))
+    return data.shape, data.dtype.str, hashlib.blake2b(data.view(np.uint8).reshape(-1), digest_size=16).digest()
+
+
+def annotated_timepoints(annotation):
+    """
+    Returns the indices of all time points in a 4D (t, z, y, x) reference image that contain annotations.
+    """
+    return [t for t in range(annotation.shape[0]) if np.any(np.asarray(annotation[t]))]
+
+
+def timepoint_data(data, t):
+    """
+    Crops out the time point t of a 4D image in the same way as napari-time-slicer does it:
+    In case the resulting 3D image has only one slice, the 2D image is returned.
+    """
+    result = data[t]
+    if result.shape[0] == 1:
+        result = result[0]
+    return result
+
+
+def timepoint_workflow(workflow: Workflow, t):
+    """
+    Returns a shallow copy of the given workflow where all 4D images are replaced by their time point t.
+    References to a napari viewer are removed, so that time-sliced functions do not crop out the time point
+    currently selected in the viewer instead.
+    """
+    result = _empty_copy(workflow, t)
+    for name, task in workflow._tasks.items():
+        if _is_timelapse(task):
+            task = timepoint_data(task, t)
+        elif isinstance(task, tuple) and callable(task[0]):
+            task = tuple([task[0]] + [_timepoint_argument(argument, t) for argument in task[1:]])
+        result.set_task(name, task)
+    return result
+
+
+def _timepoint_argument(argument, t):
+    if _is_timelapse(argument):
+        return timepoint_data(argument, t)
+    if _is_viewer(argument):
+        return None
+    return argument
+
+
+def _is_viewer(argument):
+    return "napari.viewer.Viewer" in str(type(argument))
+
+
+def _is_timelapse(data):
+    return hasattr(data, "shape") and hasattr(data, "dtype") and len(data.shape) == 4
+
 
 class SparseAnnotatedBinaryImageOptimizer(Optimizer):
     def __init__(self, workflow: Workflow):
@@ -320,10 +990,188 @@ class JaccardLabelImageOptimizer(Optimizer):
         return quality
 
 
-class MeanSquaredErrorImageOptimizer(Optimizer):
-    def __init__(self, workflow: Workflow):
+class _BlockwiseImageOptimizer(Optimizer):
+    """
+    Base class for optimizers comparing intensity images block by block. The reference image is converted
+    once per run and kept in memory (or memory-mapped, if it is a numpy memmap) across its evaluations. Only one block of
+    block_size pixels is converted to floating point at a time, which bounds the additional memory needed.
+    """
+    def __init__(self, workflow: Workflow, block_size: int = 2 ** 20):
+        from threading import Lock
         super().__init__(workflow)
+        self._block_size = block_size
+        self._mask = None
+        # reference key -> (reference, converted reference, data range)
+        self._references = {}
+        self._references_lock = Lock()
+
+    def __getstate__(self):
+        # converted references are not sent to other processes
+        state = super().__getstate__()
+        state["_references"] = {}
+        del state["_references_lock"]
+        return state
+
+    def __setstate__(self, state):
+        from threading import Lock
+        super().__setstate__(state)
+        self._references_lock = Lock()
+
+    def _clear_caches(self):
+        with self._references_lock:
+            self._references.clear()
+
+    def _copy_for(self, workflow: Workflow):
+        from threading import Lock
+        result = super()._copy_for(workflow)
+        result._references = {}
+        result._references_lock = Lock()
+        return result
+
+    def set_mask(self, mask):
+        """
+        Restricts the comparison to pixels where the given mask image is not zero. Pass None to compare all pixels.
+        In timelapse mode, the mask may be a 4D image with a mask per time point.
+        """
+        self._mask = None if mask is None else np.asarray(mask)
 
     def _fitness(self, test, reference):
-        import pyclesperanto_prototype as cle
-        return 1/cle.mean_squared_error(test, reference)
+        return self._masked_fitness(test, reference, self._mask)
+
+    def _timepoint_fitness(self, test, annotation, t):
+        mask = self._mask
+        if mask is not None and _is_timelapse(mask):
+            mask = timepoint_data(mask, t)
+        return self._masked_fitness(test, timepoint_data(annotation, t), mask)
+
+    def _prepare_reference(self, reference):
+        """
+        Converts the reference image once, e.g. pulls it from the GPU, and keeps it for subsequent evaluations
+        until the end of the run.
+        Views of the same numpy array, e.g. time points of a time-lapse, are recognized. Several references
+        can be used from several threads at the same time.
+
+        Returns
+        -------
+        The reference as numpy array and its intensity range
+        """
+        if isinstance(reference, np.ndarray):
+            interface = reference.__array_interface__
+            key = (interface["data"][0], reference.shape, interface["strides"], reference.dtype.str)
+        else:
+            key = id(reference)
+        with self._references_lock:
+            entry = self._references.get(key)
+        # the stored reference keeps the memory alive, so that its address cannot be reused by another image
+        if entry is None or (not isinstance(reference, np.ndarray) and entry[0] is not reference):
+            data = reference if isinstance(reference, np.ndarray) else np.asarray(reference)
+            entry = (reference, data, float(data.max()) - float(data.min()))
+            with self._references_lock:
+                if len(self._references) >= 64:
+                    self._references.pop(next(iter(self._references)))
+                self._references[key] = entry
+        return entry[1], entry[2]
+
+    def _blocks(self, test, reference, mask):
+        """
+        Yields corresponding flat blocks of test and reference images as float arrays, restricted to the mask.
+        """
+        test = np.asarray(test).reshape(-1)
+        reference = reference.reshape(-1)
+        mask = None if mask is None else mask.reshape(-1)
+        for start in range(0, len(reference), self._block_size):
+            end = start + self._block_size
+            test_block = test[start:end].astype(float)
+            reference_block = reference[start:end].astype(float)
+            if mask is not None:
+                selection = mask[start:end] != 0
+                test_block = test_block[selection]
+                reference_block = reference_block[selection]
+            yield test_block, reference_block
+
+    def _mean_squared_error(self, test, reference, mask):
+        sum_of_squares = 0
+        count = 0
+        for test_block, reference_block in self._blocks(test, reference, mask):
+            test_block -= reference_block
+            sum_of_squares += np.dot(test_block, test_block)
+            count += len(test_block)
+        # avoid division by zero for perfect matches
+        return max(sum_of_squares / max(count, 1), np.finfo(float).eps)
+
+
+class MeanSquaredErrorImageOptimizer(_BlockwiseImageOptimizer):
+    def __init__(self, workflow: Workflow, block_size: int = 2 ** 20):
+        super().__init__(workflow, block_size)
+
+    def _masked_fitness(self, test, reference, mask):
+        """
+        Determine the inverse mean squared error between test and reference image.
+        """
+        reference, _ = self._prepare_reference(reference)
+        return 1 / self._mean_squared_error(test, reference, mask)
+
+
+class PeakSignalToNoiseRatioImageOptimizer(_BlockwiseImageOptimizer):
+    def __init__(self, workflow: Workflow, block_size: int = 2 ** 20):
+        super().__init__(workflow, block_size)
+
+    def _masked_fitness(self, test, reference, mask):
+        """
+        Determine the peak signal to noise ratio in dB, using the intensity range of the reference image as peak.
+        """
+        reference, data_range = self._prepare_reference(reference)
+        mse = self._mean_squared_error(test, reference, mask)
+        peak = data_range if data_range > 0 else 1
+        return 10 * np.log10(peak ** 2 / mse)
+
+
+class StructuralSimilarityImageOptimizer(_BlockwiseImageOptimizer):
+    def __init__(self, workflow: Workflow, block_size: int = 2 ** 20, window_size: int = 7):
+        super().__init__(workflow, block_size)
+        self._window_size = window_size
+
+    def _masked_fitness(self, test, reference, mask):
+        """
+        Determine the mean structural similarity index (SSIM) between test and reference image using a uniform
+        window as scikit-image does by default. The images are processed in slabs along the first axis,
+        extended by half a window on both sides so that the result is independent of the slab size.
+        """
+        from scipy.ndimage import uniform_filter
+
+        test = np.asarray(test)
+        reference, data_range = self._prepare_reference(reference)
+
+        size = self._window_size
+        pad = (size - 1) // 2
+        data_range = max(data_range, np.finfo(float).eps)
+        c1 = (0.01 * data_range) ** 2
+        c2 = (0.03 * data_range) ** 2
+        # sample covariance
+        cov_norm = size ** reference.ndim / (size ** reference.ndim - 1)
+
+        inner = tuple([slice(pad, -pad if pad > 0 else None)] * (reference.ndim - 1))
+        slab_thickness = max(1, self._block_size // max(1, reference[0].size))
+
+        sum_of_ssim = 0
+        count = 0
+        for start in range(pad, reference.shape[0] - pad, slab_thickness):
+            end = min(start + slab_thickness, reference.shape[0] - pad)
+            x = test[start - pad:end + pad].astype(float)
+            y = reference[start - pad:end + pad].astype(float)
+
+            ux = uniform_filter(x, size)
+            uy = uniform_filter(y, size)
+            vx = cov_norm * (uniform_filter(x * x, size) - ux * ux)
+            vy = cov_norm * (uniform_filter(y * y, size) - uy * uy)
+            vxy = cov_norm * (uniform_filter(x * y, size) - ux * uy)
+
+            ssim = ((2 * ux * uy + c1) * (2 * vxy + c2)) / ((ux ** 2 + uy ** 2 + c1) * (vx + vy + c2))
+            ssim = ssim[(slice(pad, pad + end - start),) + inner]
+
+            if mask is not None:
+                ssim = ssim[mask[(slice(start, end),) + inner] != 0]
+            sum_of_ssim += ssim.sum()
+            count += ssim.size
+
+        return sum_of_ssim / max(count, 1)
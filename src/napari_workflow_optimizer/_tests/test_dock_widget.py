@@ -62,12 +62,29 @@ def test_optimizer_with_assistant(make_napari_viewer):
     optimizer_gui._enable_gui(True)
     optimizer_gui.maxiter_select.value = 1
 
+    optimizer_gui._on_sensitivity_click(_for_testing=True)
+
+    optimizer_gui._live_update_checkbox.setChecked(True)
     optimizer_gui._on_run_click(_for_testing=True)
 
     optimizer_gui._on_undo_click()
 
-    optimizer_gui._optimizer._iteration = [1, 2]
-    optimizer_gui._optimizer._quality = [0.1, 0.2]
+    optimizer_gui._on_queue_click()
+    assert optimizer_gui._job_queue.wait(timeout=60)
+    optimizer_gui._update_job_list()
+    optimizer_gui._job_list.setCurrentRow(0)
+    optimizer_gui._on_cancel_job_click()
+    optimizer_gui._on_apply_job_click()
+    optimizer_gui._on_undo_click()
+    job = optimizer_gui._job_queue.get_jobs()[0]
+    assert optimizer_gui._optimizer.get_all_numeric_parameters() == job.get_undo_parameters()
+
+    from napari_workflow_optimizer import EvaluationHistory
+    history = EvaluationHistory(["voronoi_otsu_labeling spot_sigma"])
+    for quality in [0.1, 0.2]:
+        history.append([1], quality)
+        history.mark_iteration()
+    optimizer_gui._optimizer._history = history
     optimizer_gui._plot_quality()
 
     num_dw = len(viewer.window._dock_widgets)
@@ -78,8 +95,85 @@ def test_optimizer_with_assistant(make_napari_viewer):
     assert len(viewer.window._dock_widgets) == num_dw + 1
 
 
+def test_downsample_inputs():
+    import numpy as np
+    from napari_workflow_optimizer import Workflow
+    from napari_workflow_optimizer.gui._live_preview import downsample_inputs
+
+    w = Workflow()
+    w.set("input", np.zeros((3, 10, 10)))
+    w.set("blurred", np.sum, "input")
+
+    downsample_inputs(w, 2)
 
+    assert w.get_task("input").shape == (3, 5, 5)
+    assert w.get_task("blurred")[1] == "input"
 
 
+def _threshold(image, threshold: float = 50):
+    return image > threshold
 
 
+class _PreviewViewer():
+    def __init__(self):
+        self.layers = []
+
+    def add_labels(self, data, name, scale):
+        from types import SimpleNamespace
+        layer = SimpleNamespace(data=data, name=name, scale=scale)
+        self.layers.append(layer)
+        return layer
+
+
+def test_live_preview(qtbot):
+    import numpy as np
+    from types import SimpleNamespace
+    from napari_workflow_optimizer import Workflow, JaccardLabelImageOptimizer, EvaluationHistory
+    from napari_workflow_optimizer.gui._live_preview import LivePreview
+
+    image = np.arange(100).reshape(10, 10)
+    w = Workflow()
+    w.set("binarized", _threshold, "input", threshold=50)
+    w.set("input", image)
+    optimizer = JaccardLabelImageOptimizer(w)
+    optimizer._history = EvaluationHistory(optimizer.get_numeric_parameter_names())
+
+    viewer = _PreviewViewer()
+    preview = LivePreview(viewer, optimizer, SimpleNamespace(name="binarized", scale=(1, 1)), min_interval=3600)
+
+    # nothing evaluated yet
+    preview.update()
+    assert preview._worker is None
+
+    optimizer._history.append([60], 0.5)
+    preview.update()
+    qtbot.waitUntil(lambda: not preview._busy)
+    assert len(viewer.layers) == 1
+    assert np.array_equal(viewer.layers[0].data, image > 60)
+    # the preview is computed on a copy of the workflow
+    assert w.get_task("binarized")[2] == 50
+
+    # updates are rate-limited
+    optimizer._history.append([70], 0.6)
+    worker = preview._worker
+    preview.update()
+    assert preview._worker is worker
+
+    preview._min_interval = 0
+    preview.update()
+    assert preview._worker is not worker
+    qtbot.waitUntil(lambda: not preview._busy)
+    assert np.array_equal(viewer.layers[0].data, image > 70)
+
+    # the preview is only computed again if the best result changed
+    worker = preview._worker
+    preview.update()
+    assert preview._worker is worker
+
+    # a preview computed while removing the layer is not shown
+    optimizer._history.append([80], 0.7)
+    preview.update()
+    viewer.layers.clear()
+    preview.remove()
+    qtbot.waitUntil(lambda: not preview._busy)
+    assert viewer.layers == []
@@ -88,3 +88,712 @@ def test_sparse_label_image_optimizer():
     result = w.get("labeled")
 
     assert abs(result.max() - 90) < 2  # accept an error of 2 in object count
+
+
+processed_frames = []
+
+
+def threshold_and_remember(image, threshold: float = 50):
+    processed_frames.append(float(image.max()))
+    return (image > threshold).astype(int)
+
+
+def test_timelapse_optimizer():
+    import numpy as np
+
+    # other tests use threshold_and_remember as well
+    processed_frames.clear()
+
+    y, x = np.mgrid[0:20, 0:20]
+    frame = 100 * np.exp(-((y - 10) ** 2 + (x - 10) ** 2) / 50)[np.newaxis]
+    # every frame gets a different maximum intensity so that we can tell them apart
+    timelapse = np.asarray([frame + t for t in range(3)])
+
+    # annotate time points 0 and 2 only
+    ground_truth = np.zeros(timelapse.shape, dtype=int)
+    ground_truth[0] = frame > 50
+    ground_truth[2] = frame > 50
+
+    w = Workflow()
+    w.set("binarized", threshold_and_remember, "input", threshold=75)
+    w.set("input", timelapse)
+
+    jlio = JaccardLabelImageOptimizer(w)
+    best_param = jlio.optimize("binarized", ground_truth, maxiter=20, timelapse=True)
+
+    assert abs(best_param[0] - 50) < 5
+    assert set(processed_frames) == {100, 102}
+
+
+def slow_threshold(image, threshold: float = 50):
+    import time
+    # only the starting point can be evaluated quickly
+    if threshold != 75:
+        time.sleep(60)
+    return (image > threshold).astype(int)
+
+
+def _optimize_and_cancel(optimizer, target, reference, started, **kwargs):
+    import time
+    from threading import Thread
+
+    result = {}
+    thread = Thread(target=lambda: result.update(best=optimizer.optimize(target, reference, maxiter=100, **kwargs)))
+    thread.start()
+    while not started(optimizer):
+        time.sleep(0.01)
+
+    start_time = time.time()
+    num_evaluations = optimizer._counter
+    optimizer.cancel()
+    thread.join()
+    return result["best"], time.time() - start_time, num_evaluations
+
+
+def test_cancel_optimization():
+    import numpy as np
+
+    w = Workflow()
+    w.set("binarized", threshold_and_remember, "input", threshold=75)
+    w.set("input", np.random.random((100, 100)) * 100)
+    jlio = JaccardLabelImageOptimizer(w)
+
+    best_param, latency, num_evaluations = _optimize_and_cancel(
+        jlio, "binarized", (np.random.random((100, 100)) > 0.5) * 1, lambda o: o._counter > 5)
+
+    assert latency < 1
+    assert len(best_param) == 1
+    assert not jlio.is_running()
+    # once cancelled, no further evaluation is started
+    assert jlio._counter - num_evaluations <= 1
+
+    # cancelling after the optimization finished does not affect the next one
+    jlio.cancel()
+    jlio.optimize("binarized", (np.random.random((100, 100)) > 0.5) * 1, maxiter=2)
+    assert jlio.get_stop_reason() != "cancelled"
+    assert len(jlio.get_history()) > 0
+
+
+def test_cancel_evaluation_in_process():
+    import numpy as np
+
+    w = Workflow()
+    w.set("binarized", slow_threshold, "input", threshold=75)
+    w.set("input", np.random.random((100, 100)) * 100)
+    jlio = JaccardLabelImageOptimizer(w)
+
+    # cancel while the second (slow) evaluation is running
+    best_param, latency, _ = _optimize_and_cancel(
+        jlio, "binarized", (np.random.random((100, 100)) > 0.5) * 1, lambda o: o._counter > 1,
+        evaluate_in_process=True)
+
+    assert latency < 5
+    # the starting point is the best result evaluated so far
+    assert best_param[0] == 75
+    assert w.get_task("binarized")[2] == 75
+
+
+def test_evaluation_history(tmp_path):
+    import numpy as np
+
+    w = Workflow()
+    w.set("blurred", cle.gaussian_blur, "input", sigma_x=7, sigma_y=3)
+    input_image = imread("demo/blobs.tif")
+    w.set("input", input_image)
+    ground_truth = cle.gaussian_blur(input_image, sigma_x=3, sigma_y=5)
+
+    mseio = MeanSquaredErrorImageOptimizer(w)
+    mseio.fix_parameter(2)
+    assert mseio.get_number_of_duplicate_outputs() == 0
+    mseio.optimize("blurred", ground_truth, maxiter=3)
+
+    history = mseio.get_history()
+    iterations, quality = mseio.get_plot()
+
+    # every evaluation is recorded, not only finished iterations
+    assert len(history) > len(iterations)
+    assert history.parameters.shape == (len(history), 2)
+    assert history.parameter_names == mseio.get_numeric_parameter_names()
+    assert list(iterations) == list(range(1, len(iterations) + 1))
+    assert np.all(history.cache_hit[history.iteration > 0])
+    assert not np.any(history.failed)
+    assert np.array_equal(mseio.get_best_result(), history.parameters[np.argmax(history.quality)])
+
+    history.save(tmp_path / "history.npz")
+    history.save(tmp_path / "history.csv")
+    loaded = np.load(tmp_path / "history.npz")
+    assert np.array_equal(loaded["quality"], history.quality)
+    csv = np.loadtxt(tmp_path / "history.csv", delimiter=",", skiprows=1)
+    assert csv.shape == (len(history), 8)
+
+
+def threshold_with_unused_parameter(image, threshold: float = 50, unused: float = 1):
+    return (image > threshold).astype(int)
+
+
+def test_sensitivity_analysis():
+    import numpy as np
+
+    y, x = np.mgrid[0:20, 0:20]
+    image = 100 * np.exp(-((y - 10) ** 2 + (x - 10) ** 2) / 50)
+
+    w = Workflow()
+    w.set("binarized", threshold_with_unused_parameter, "input", threshold=75, unused=3)
+    w.set("input", image)
+
+    jlio = JaccardLabelImageOptimizer(w)
+    sensitivities = jlio.analyse_sensitivity("binarized", (image > 50) * 1, fix_insensitive=True)
+
+    assert sensitivities[0] > 0
+    assert sensitivities[1] == 0
+    assert jlio.get_numeric_parameters() == [75]
+    # the workflow itself is not modified during the analysis
+    assert w.get_task("binarized")[2:] == (75, 3)
+
+    best_param = jlio.optimize("binarized", (image > 50) * 1, maxiter=20)
+    assert len(best_param) == 1
+
+    # small steps stay on a plateau of the quality landscape, larger ones do not
+    levels = np.repeat(np.arange(0, 101, 25), 4).reshape(4, 5)
+    w.set("binarized", threshold_with_unused_parameter, "input", threshold=60, unused=3)
+    w.set("input", levels)
+    jlio = JaccardLabelImageOptimizer(w)
+    assert jlio.analyse_sensitivity("binarized", (levels > 30) * 1)[0] == 0
+    assert jlio.analyse_sensitivity("binarized", (levels > 30) * 1, relative_step=[0.1, 0.4])[0] > 0
+
+    # time-lapse references are compared time point by time point
+    timelapse = np.asarray([image[np.newaxis]] * 2)
+    w.set("binarized", threshold_with_unused_parameter, "input", threshold=75, unused=3)
+    w.set("input", timelapse)
+    jlio = JaccardLabelImageOptimizer(w)
+    sensitivities = jlio.analyse_sensitivity("binarized", (timelapse > 50) * 1, timelapse=True)
+    assert sensitivities[0] > 0
+    assert sensitivities[1] == 0
+
+
+def test_blockwise_intensity_fitness():
+    import numpy as np
+    from skimage.metrics import mean_squared_error, peak_signal_noise_ratio, structural_similarity
+    from napari_workflow_optimizer import PeakSignalToNoiseRatioImageOptimizer, StructuralSimilarityImageOptimizer
+
+    reference = imread("demo/blobs.tif").astype(float)
+    test = np.asarray(cle.gaussian_blur(reference, sigma_x=2, sigma_y=2))
+    data_range = reference.max() - reference.min()
+
+    w = Workflow()
+    # small blocks to make sure results do not depend on how images are split
+    mseio = MeanSquaredErrorImageOptimizer(w, block_size=1000)
+    psnrio = PeakSignalToNoiseRatioImageOptimizer(w, block_size=1000)
+    ssimio = StructuralSimilarityImageOptimizer(w, block_size=1000)
+
+    assert np.isclose(mseio._fitness(test, reference), 1 / mean_squared_error(reference, test))
+    assert np.isclose(psnrio._fitness(test, reference), peak_signal_noise_ratio(reference, test, data_range=data_range))
+    assert np.isclose(ssimio._fitness(test, reference), structural_similarity(reference, test, data_range=data_range))
+
+    # perfect matches do not divide by zero
+    assert np.isfinite(mseio._fitness(reference, reference))
+    assert np.isclose(ssimio._fitness(reference, reference), 1)
+
+    # only pixels inside the mask are compared
+    mask = np.zeros(reference.shape, dtype=bool)
+    mask[:100] = True
+    mseio.set_mask(mask)
+    assert np.isclose(mseio._fitness(test, reference), 1 / mean_squared_error(reference[:100], test[:100]))
+
+
+def multiply(image, factor: float = 1):
+    return image * factor
+
+
+def test_timelapse_intensity_fitness():
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    from napari_workflow_optimizer import PeakSignalToNoiseRatioImageOptimizer, StructuralSimilarityImageOptimizer
+    from napari_workflow_optimizer._optimizer import timepoint_data
+
+    y, x = np.mgrid[0:32, 0:32]
+    frames = [np.exp(-((y - 4 * t) ** 2 + (x - 16) ** 2) / 40) * (t + 1) for t in range(8)]
+    timelapse = np.asarray(frames)[:, np.newaxis]
+    mask = np.zeros(timelapse.shape, dtype=bool)
+    for t in range(8):
+        mask[t, 0, :, :4 * (t + 1)] = True
+
+    for optimizer_class in [MeanSquaredErrorImageOptimizer, PeakSignalToNoiseRatioImageOptimizer,
+                            StructuralSimilarityImageOptimizer]:
+        # time points are compared in parallel with the same optimizer
+        optimizer = optimizer_class(Workflow())
+        expected = [optimizer_class(Workflow())._fitness(frames[t] * 1.1, frames[t].copy()) for t in range(8)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            measured = list(executor.map(lambda t: optimizer._timepoint_fitness(frames[t] * 1.1, timelapse, t),
+                                         list(range(8)) * 20))
+        assert np.allclose(measured, expected * 20)
+
+        # a 4D mask is cropped to the time point
+        optimizer.set_mask(mask)
+        expected = optimizer_class(Workflow())
+        expected.set_mask(timepoint_data(mask, 5))
+        assert np.isclose(optimizer._timepoint_fitness(frames[5] * 1.1, timelapse, 5),
+                          expected._fitness(frames[5] * 1.1, frames[5]))
+
+        w = Workflow()
+        w.set("scaled", multiply, "input", factor=0.8)
+        w.set("input", timelapse)
+        best_param = optimizer_class(w).optimize("scaled", timelapse, maxiter=30, timelapse=True)
+        assert abs(best_param[0] - 1) < 0.05
+
+
+def test_reference_edited_between_runs():
+    import numpy as np
+    from napari_workflow_optimizer import PeakSignalToNoiseRatioImageOptimizer
+
+    reference = imread("demo/blobs.tif").astype(float)
+    w = Workflow()
+    w.set("scaled", multiply, "input", factor=0.8)
+    w.set("input", reference.copy())
+    psnrio = PeakSignalToNoiseRatioImageOptimizer(w)
+    psnrio.optimize("scaled", reference, maxiter=2)
+
+    # layer data is edited in place, the intensity range has to be determined again in the next run
+    reference *= 10
+    w.set("input", reference.copy())
+    psnrio.optimize("scaled", reference, maxiter=2)
+    expected = PeakSignalToNoiseRatioImageOptimizer(w)._fitness(0.8 * reference, reference)
+    assert np.isclose(psnrio.get_history().quality[0], expected)
+    assert psnrio._references == {}
+
+
+def _gaussian_blob_threshold_workflow():
+    import numpy as np
+
+    y, x = np.mgrid[0:20, 0:20]
+    image = 100 * np.exp(-((y - 10) ** 2 + (x - 10) ** 2) / 50)
+
+    w = Workflow()
+    w.set("binarized", threshold_and_remember, "input", threshold=75)
+    w.set("input", image)
+    return w, (image > 50) * 1
+
+
+def test_ask_tell():
+    import pytest
+
+    w, ground_truth = _gaussian_blob_threshold_workflow()
+    jlio = JaccardLabelImageOptimizer(w)
+
+    for _ in range(20):
+        candidates = jlio.ask(4)
+        qualities = []
+        for x in candidates:
+            jlio.set_numeric_parameters(x)
+            qualities.append(jlio._fitness(w.get("binarized"), ground_truth))
+        jlio.tell(candidates, qualities)
+
+    # failed evaluations are accepted as well
+    jlio.tell(jlio.ask(1), [None])
+    index = len(jlio.get_history()) - 1
+
+    # the search moves away from the starting point towards the optimum at 50
+    assert abs(jlio.get_best_result()[0] - 50) < 20
+    assert len(jlio.get_history()) == 81
+    assert jlio.get_history().failed.sum() == 1
+
+    # results arriving late replace the failure
+    jlio.tell([jlio.get_history().parameters[index]], [0.1], history_indices=[index])
+    assert len(jlio.get_history()) == 81
+    assert jlio.get_history().failed.sum() == 0
+    assert jlio.get_history().quality[index] == 0.1
+
+    # Nelder-Mead and ask/tell searches do not share their state
+    jlio.optimize("binarized", ground_truth, maxiter=2)
+    num_evaluations = len(jlio.get_history())
+    jlio.tell(jlio.ask(2), [0.1, 0.2])
+    assert len(jlio.get_history()) == 2
+    assert num_evaluations > 2
+
+    jlio.reset_ask_tell()
+    with pytest.raises(RuntimeError):
+        jlio.tell([[50]], [0.5])
+
+
+def test_broker_with_multiprocessing_workers(tmp_path):
+    import multiprocessing
+    from napari_workflow_optimizer import Broker, run_worker
+
+    w, ground_truth = _gaussian_blob_threshold_workflow()
+    jlio = JaccardLabelImageOptimizer(w)
+
+    context = multiprocessing.get_context("spawn")
+    task_queue = context.Queue()
+    result_queue = context.Queue()
+    workers = [context.Process(target=run_worker, args=(task_queue, result_queue)) for _ in range(2)]
+    for worker in workers:
+        worker.start()
+
+    broker = Broker(jlio, "binarized", ground_truth, task_queue, result_queue, tmp_path)
+    best_param = broker.run(max_evaluations=60, num_parallel=4)
+    broker.stop_workers(len(workers))
+    for worker in workers:
+        worker.join()
+    broker.close()
+
+    assert abs(best_param[0] - 50) < 20
+    assert len(jlio.get_history()) == 60
+    # the workflow of the optimizer is not modified by remote evaluations
+    assert w.get_task("binarized")[2] == 75
+
+
+def test_remote_evaluations_keep_optimizer_settings(tmp_path):
+    import numpy as np
+    import queue
+    import threading
+    from napari_workflow_optimizer import Broker, run_worker, JobQueue, OptimizationJob
+
+    image = imread("demo/blobs.tif").astype(float)
+    w = Workflow()
+    w.set("scaled", multiply, "input", factor=0.8)
+    w.set("input", image)
+    mask = np.zeros(image.shape, dtype=bool)
+    mask[:, :100] = True
+
+    mseio = MeanSquaredErrorImageOptimizer(w, block_size=1000)
+    mseio.set_mask(mask)
+
+    task_queue = queue.Queue()
+    result_queue = queue.Queue()
+    worker = threading.Thread(target=run_worker, args=(task_queue, result_queue))
+    worker.start()
+    broker = Broker(mseio, "scaled", image, task_queue, result_queue, tmp_path)
+    broker.run(max_evaluations=8, num_parallel=2)
+    broker.stop_workers(1)
+    worker.join()
+    broker.close()
+
+    # remote evaluations use the mask as well
+    histories = [mseio.get_history()]
+
+    # and so do queued jobs
+    job_queue = JobQueue(w, optimizer=mseio)
+    job = job_queue.submit(OptimizationJob("scaled", image, strategy="evolution", budget=8))
+    assert job_queue.wait(timeout=60)
+    job_queue.shutdown()
+    assert job.status == "finished"
+    histories.append(job.get_optimizer().get_history())
+
+    for history in histories:
+        for x, quality in zip(history.parameters, history.quality):
+            mseio.set_numeric_parameters(x)
+            assert np.isclose(mseio._fitness(w.get("scaled"), image), quality)
+
+
+def test_broker_with_lost_and_late_results(tmp_path):
+    import queue
+    import threading
+    import time
+    from napari_workflow_optimizer import Broker
+
+    w, ground_truth = _gaussian_blob_threshold_workflow()
+    jlio = JaccardLabelImageOptimizer(w)
+
+    task_queue = queue.Queue()
+    result_queue = queue.Queue()
+
+    num_lost = []
+    num_late = []
+
+    def unreliable_worker():
+        count = 0
+        while True:
+            task = task_queue.get()
+            if task is None:
+                return
+            count += 1
+            problem_filename, evaluation_id, _ = task
+            if count % 5 == 0:
+                num_lost.append(1)
+                continue  # result gets lost
+            if count % 5 == 1:
+                num_late.append(1)
+                time.sleep(0.3)  # result arrives late
+            result_queue.put((problem_filename, evaluation_id, 0.5))
+
+    worker = threading.Thread(target=unreliable_worker)
+    worker.start()
+
+    broker = Broker(jlio, "binarized", ground_truth, task_queue, result_queue, tmp_path, timeout=0.2)
+    # result of another broker sharing the queue
+    result_queue.put(("another problem", 1, 1.0))
+    start_time = time.time()
+    broker.run(max_evaluations=20, num_parallel=2)
+    duration = time.time() - start_time
+    broker.stop_workers(1)
+    worker.join()
+    broker.close()
+
+    history = jlio.get_history()
+    assert duration < 10
+    assert history.failed.sum() >= len(num_lost) > 0
+    # late results replace the failure
+    assert len(history) == 20
+    assert history.failed.sum() < len(num_lost) + len(num_late)
+    # results of other problems are left for their broker
+    assert 1.0 not in history.quality
+    assert ("another problem", 1, 1.0) in [result_queue.get() for _ in range(result_queue.qsize())]
+
+
+def test_skip_duplicate_outputs():
+    import numpy as np
+
+    # few intensity levels lead to a quality landscape with plateaus
+    image = np.repeat(np.arange(0, 100, 10), 10).reshape(10, 10)
+    w = Workflow()
+    w.set("binarized", threshold_and_remember, "input", threshold=75)
+    w.set("input", image)
+
+    jlio = JaccardLabelImageOptimizer(w)
+    fitness_calls = []
+    fitness = jlio._fitness
+    jlio._fitness = lambda test, reference: fitness_calls.append(1) or fitness(test, reference)
+
+    jlio.optimize("binarized", (image > 50) * 1, maxiter=20)
+    history = jlio.get_history()
+
+    assert jlio.get_number_of_duplicate_outputs() > 0
+    assert len(fitness_calls) == np.sum(~history.cache_hit & ~history.duplicate)
+
+
+def test_reuse_output_buffers():
+    import numpy as np
+
+    def optimize(reuse_output_buffers):
+        w = Workflow()
+        w.set("deblurred", cle.gaussian_blur, "input", sigma_x=5, sigma_y=5)
+        w.set("binarized", cle.threshold_otsu, "deblurred")
+        w.set("input", imread("demo/blobs.tif"))
+
+        sabio = SparseAnnotatedBinaryImageOptimizer(w)
+        best_param = sabio.optimize("binarized", imread("demo/blobs_annotated.tif"), maxiter=5,
+                                    reuse_output_buffers=reuse_output_buffers)
+        return best_param, sabio
+
+    best_param, sabio = optimize(True)
+    expected_best_param, unbuffered_sabio = optimize(False)
+
+    # every task allocates its output once, later evaluations write into the same images
+    statistics = sabio.get_buffer_statistics()
+    unbuffered_statistics = unbuffered_sabio.get_buffer_statistics()
+    assert unbuffered_statistics["reuses"] == 0
+    assert statistics["allocations"] + statistics["reuses"] == unbuffered_statistics["allocations"]
+    assert statistics["allocations"] < unbuffered_statistics["allocations"]
+    assert statistics["reuses"] > 0
+    assert np.allclose(best_param, expected_best_param)
+
+
+def test_job_queue():
+    import numpy as np
+    import pytest
+    from napari_workflow_optimizer import JobQueue, OptimizationJob
+
+    w = Workflow()
+    w.set("deblurred", cle.gaussian_blur, "input", sigma_x=5, sigma_y=5)
+    w.set("binarized", cle.greater_constant, "deblurred", constant=100)
+    w.set("input", imread("demo/blobs.tif"))
+    ground_truth = imread("demo/blobs_annotated.tif")
+
+    queue = JobQueue(w, optimizer_class=SparseAnnotatedBinaryImageOptimizer, max_concurrent=2,
+                     memory_budget=10 ** 9)
+    jobs = [
+        queue.submit(OptimizationJob("binarized", ground_truth, budget=5)),
+        # both jobs below only optimize the threshold, they share the blurred image
+        queue.submit(OptimizationJob("binarized", ground_truth, free_parameters=[3], budget=5)),
+        queue.submit(OptimizationJob("binarized", ground_truth, free_parameters=[3], strategy="evolution", budget=8)),
+    ]
+    cancelled = queue.submit(OptimizationJob("binarized", ground_truth, memory=10 ** 10))
+    cancelled.cancel()
+
+    assert queue.wait(timeout=120)
+    queue.shutdown()
+
+    assert [job.status for job in jobs] == ["finished"] * 3
+    assert cancelled.status == "cancelled"
+    assert queue.intermediate_result_hits == 1
+    assert jobs[0].get_progress()[0] > 0
+    assert jobs[2].get_progress() == (8, 8)
+    # jobs work on copies of the workflow
+    assert w.get_task("deblurred")[3:5] == (5, 5)
+
+    queue.apply(jobs[0])
+    assert np.allclose(w.get_task("deblurred")[3:5], jobs[0].get_result()[:2])
+    queue.undo(jobs[0])
+    assert w.get_task("deblurred")[3:5] == (5, 5)
+
+    # results are written by task name, even if the order of numeric parameters in the workflow changed
+    binarized = w.get_task("binarized")
+    w.remove("binarized")
+    w.set("a_new_task", cle.gaussian_blur, "input", sigma_x=1, sigma_y=1)
+    w.set_task("binarized", binarized)
+    queue.apply(jobs[2])
+    assert w.get_task("binarized")[3] == jobs[2].get_result()[3]
+    assert w.get_task("a_new_task")[3:5] == (1, 1)
+    queue.undo(jobs[2])
+    assert w.get_task("binarized")[3] == 100
+
+    # results are not written if an optimized task changed
+    w.set("binarized", cle.smaller_constant, "deblurred", constant=100)
+    with pytest.raises(ValueError):
+        queue.apply(jobs[0])
+    assert w.get_task("deblurred")[3:5] == (5, 5)
+
+    # shared intermediate results are freed when no job needs them anymore
+    assert queue._intermediate_results == {}
+    assert queue._memory_in_use == 0
+
+
+def delayed_copy(image, delay: float = 0):
+    import time
+    time.sleep(delay)
+    return image.copy()
+
+
+def test_job_queue_intermediate_results():
+    import time
+    import numpy as np
+    from napari_workflow_optimizer import JobQueue, OptimizationJob
+
+    w, ground_truth = _gaussian_blob_threshold_workflow()
+    w.set("slow", delayed_copy, "input", delay=6)
+    w.set("fast", delayed_copy, "input", delay=0)
+    w.set("binarized_slow", threshold_and_remember, "slow", threshold=75)
+    w.set("binarized_fast", threshold_and_remember, "fast", threshold=75)
+    names = JaccardLabelImageOptimizer(w).get_all_numeric_parameter_names()
+    threshold_indices = [i for i, [name, parameter] in enumerate(names) if parameter == "threshold"]
+
+    queue = JobQueue(w, max_concurrent=2)
+    slow = queue.submit(OptimizationJob("binarized_slow", ground_truth, free_parameters=threshold_indices, budget=3))
+    fast = queue.submit(OptimizationJob("binarized_fast", ground_truth, free_parameters=threshold_indices, budget=3))
+
+    # computing an intermediate result only blocks jobs which need the same one
+    start_time = time.time()
+    while not fast.is_done() and time.time() - start_time < 5:
+        time.sleep(0.01)
+    assert fast.status == "finished"
+    assert slow.status == "running"
+
+    # cancelling while intermediate results are computed prevents the optimization
+    slow.cancel()
+    assert queue.wait(timeout=10)
+    queue.shutdown()
+    assert slow.status == "cancelled"
+    assert slow.get_optimizer().get_history() is None
+    assert queue._intermediate_results == {}
+    assert queue._memory_in_use == 0
+
+
+copied_shapes = []
+
+
+def copy_and_count(image):
+    copied_shapes.append(image.shape)
+    return image.copy()
+
+
+def test_job_queue_timelapse_intermediate_results():
+    import numpy as np
+    from napari_workflow_optimizer import JobQueue, OptimizationJob
+    from napari_workflow_optimizer._optimizer import without_viewer
+
+    processed_frames.clear()
+    copied_shapes.clear()
+
+    y, x = np.mgrid[0:20, 0:20]
+    frame = 100 * np.exp(-((y - 10) ** 2 + (x - 10) ** 2) / 50)[np.newaxis]
+    timelapse = np.asarray([frame + t for t in range(5)])
+    # annotate time point 2 only
+    ground_truth = np.zeros(timelapse.shape, dtype=int)
+    ground_truth[2] = frame > 50
+
+    w = Workflow()
+    w.set("copied", copy_and_count, "input")
+    w.set("binarized", threshold_and_remember, "copied", threshold=75)
+    w.set("input", timelapse)
+
+    queue = JobQueue(w)
+    jobs = [queue.submit(OptimizationJob("binarized", ground_truth, budget=3, timelapse=True,
+                                         reuse_output_buffers=True)),
+            queue.submit(OptimizationJob("binarized", ground_truth, strategy="evolution", budget=4,
+                                         timelapse=True))]
+    assert queue.wait(timeout=30)
+    queue.shutdown()
+    assert [job.status for job in jobs] == ["finished", "finished"]
+
+    # the constant task is computed once for the annotated time point and used by both jobs
+    assert copied_shapes == [(20, 20)]
+    assert queue.intermediate_result_hits == 1
+    assert set(processed_frames) == {102}
+    assert queue._intermediate_results == {}
+    assert queue._memory_in_use == 0
+
+    # copies sent to other processes keep precomputed results
+    precomputed = jobs[0]._workflow
+    precomputed._precomputed["copied"] = timelapse
+    precomputed._timepoint_precomputed[2] = {"copied": timelapse[2, 0]}
+    copy = without_viewer(precomputed)
+    assert copy.get("copied") is not None and copy.get("copied").shape == timelapse.shape
+    assert copy._timepoint_precomputed[2]["copied"].shape == (20, 20)
+    assert copied_shapes == [(20, 20)]
+
+
+def test_stopping_rules():
+    import numpy as np
+
+    image = np.repeat(np.arange(0, 100, 10), 10).reshape(10, 10)
+    w = Workflow()
+    w.set("binarized", threshold_and_remember, "input", threshold=75)
+    w.set("input", image)
+    reference = (image > 50) * 1
+
+    jlio = JaccardLabelImageOptimizer(w)
+    jlio.optimize("binarized", reference, maxiter=100, max_evaluations=5)
+    history = jlio.get_history()
+    assert jlio.get_stop_reason() == "max_evaluations"
+    assert np.sum(~history.cache_hit) == 5
+
+    # thresholds around 50 reproduce the reference exactly
+    blob_workflow, blob_reference = _gaussian_blob_threshold_workflow()
+    blob_optimizer = JaccardLabelImageOptimizer(blob_workflow)
+    blob_optimizer.optimize("binarized", blob_reference, maxiter=100)
+    num_evaluations = len(blob_optimizer.get_history())
+    best = blob_optimizer.optimize("binarized", blob_reference, maxiter=100, target_quality=0.99)
+    assert blob_optimizer.get_stop_reason() == "target_quality"
+    assert blob_optimizer.get_history().get_max_quality() >= 0.99
+    assert len(blob_optimizer.get_history()) < num_evaluations
+    blob_workflow.set("binarized", threshold_and_remember, "input", threshold=best[0])
+    assert np.array_equal(blob_workflow.get("binarized"), blob_reference)
+
+    # few intensity levels lead to plateaus where quality does not improve
+    jlio.optimize("binarized", reference, maxiter=100, patience=3, min_improvement=0.5)
+    assert jlio.get_stop_reason() == "no_improvement"
+    assert np.sum(~jlio.get_history().cache_hit) == 4
+
+    jlio.optimize("binarized", reference, maxiter=1)
+    assert jlio.get_stop_reason() == "maxiter"
+    assert w.get_task("binarized")[2] == 75
+
+
+def test_max_time_aborts_running_evaluation():
+    import time
+    import numpy as np
+
+    w = Workflow()
+    w.set("binarized", slow_threshold, "input", threshold=75)
+    w.set("input", np.random.random((100, 100)) * 100)
+    jlio = JaccardLabelImageOptimizer(w)
+
+    # all evaluations but the first take a minute
+    start_time = time.time()
+    best_param = jlio.optimize("binarized", (np.random.random((100, 100)) > 0.5) * 1, maxiter=100,
+                               max_time=2, evaluate_in_process=True)
+
+    assert time.time() - start_time < 10
+    assert jlio.get_stop_reason() == "max_time"
+    assert best_param[0] == 75
+    assert not jlio.is_cancelling()
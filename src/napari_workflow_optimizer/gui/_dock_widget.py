@@ -8,7 +8,9 @@ Replace code below according to your needs.
 """
 import numpy as np
 from napari_plugin_engine import napari_hook_implementation
-from qtpy.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QCheckBox, QLabel, QDoubleSpinBox
+from qtpy.QtWidgets import QWidget, QVBoxLayout, QHBoxLayout, QPushButton, QCheckBox, QLabel, QDoubleSpinBox, \
+    QListWidget
+from qtpy.QtCore import QTimer
 from magicgui import magic_factory
 
 from napari_workflow_optimizer._optimizer import JaccardLabelImageOptimizer
@@ -55,16 +57,55 @@ class WorkflowOptimizer(QWidget):
         self._undo_button.setVisible(False)
         self._undo_button.setToolTip("Load parameter settings from before last optimization.\nIf you run optimization again, original settings are overwritten.")
 
+        self._sensitivity_button = QPushButton("Analyse sensitivity")
+        self._sensitivity_button.clicked.connect(self._on_sensitivity_click)
+        self._sensitivity_button.setToolTip("Varies selected parameters one at a time and measures the quality change.\nParameters which do not influence quality are deselected.")
+        self._sensitivity_label = QLabel("")
+        self._sensitivity_label.setWordWrap(True)
+        self.layout().addWidget(self._sensitivity_button)
+        self.layout().addWidget(self._sensitivity_label)
+
         self._live_update_checkbox = QCheckBox("Live-update")
-        self._live_update_checkbox.setToolTip("This updates the segmentation result in the viewer while optimization.\nActivating live-update makes the optimization \nvery slow but potentially nice to look at.")
-        self.layout().addWidget(self._live_update_checkbox)
+        self._live_update_checkbox.setToolTip("This shows the best segmentation result so far in a separate preview layer while optimization.\nThe preview is computed on a copy of the workflow at most once per second.")
+        self._preview_downsample_select = create_widget(widget_type="SpinBox",
+                                        name='preview_downsampling',
+                                        value=1,
+                                        options=dict(min=1, step=1))
+        self._preview_downsample_select.native.setToolTip("Compute the live preview on every n-th pixel only.")
+        self.layout().addWidget(vertical_widget(self._live_update_checkbox, self._preview_downsample_select.native))
         self.layout().addWidget(vertical_widget(QLabel("Number of iterations"), self.maxiter_select.native))
         self.layout().addWidget(vertical_widget(self._push_button, self._undo_button))
+
+        self._job_queue = None
+        self._applied_job = None
+        self._queue_button = QPushButton("Add to queue")
+        self._queue_button.clicked.connect(self._on_queue_click)
+        self._queue_button.setToolTip("Optimize the selected target and parameters later.\nQueued optimizations run one after another on a copy of the workflow.")
+        self._apply_job_button = QPushButton("Apply selected")
+        self._apply_job_button.clicked.connect(self._on_apply_job_click)
+        self._cancel_job_button = QPushButton("Cancel selected")
+        self._cancel_job_button.clicked.connect(self._on_cancel_job_click)
+        self._cancel_job_button.setToolTip("Removes the selected optimization from the queue or stops it.")
+        self._job_list = QListWidget()
+        self._job_list.setMaximumHeight(100)
+        self._job_list.setVisible(False)
+        self._apply_job_button.setVisible(False)
+        self._cancel_job_button.setVisible(False)
+        self.layout().addWidget(vertical_widget(self._queue_button, self._apply_job_button))
+        self.layout().addWidget(self._cancel_job_button)
+        self.layout().addWidget(self._job_list)
+        self._job_timer = QTimer()
+        self._job_timer.timeout.connect(self._update_job_list)
+
         self.layout().setSpacing(10)
         self._result_plot = None
 
     def _enable_gui(self, enabled:bool):
         self._undo_button.setEnabled(enabled)
+        self._sensitivity_button.setEnabled(enabled)
+        # queued jobs copy the workflow and applying results modifies it
+        self._queue_button.setEnabled(enabled)
+        self._apply_job_button.setEnabled(enabled)
         self.labels_select.native.setEnabled(enabled)
         self.reference_select.native.setEnabled(enabled)
         for cb in self._parameter_checkboxes:
@@ -90,7 +131,15 @@ class WorkflowOptimizer(QWidget):
         return button
 
     def _on_undo_click(self):
-        self._optimizer.set_numeric_parameters(self._original_parameters)
+        if self._applied_job is not None:
+            # the job may have changed parameters which are constants in this widget
+            try:
+                self._job_queue.undo(self._applied_job)
+            except ValueError as e:
+                warnings.warn(str(e))
+                return
+        else:
+            self._optimizer.set_numeric_parameters(self._original_parameters)
         self._undo_button.setVisible(False)
         if self._result_plot is not None: # remove old plot if it existed already
             self.layout().removeWidget(self._result_plot)
@@ -103,16 +152,11 @@ class WorkflowOptimizer(QWidget):
             return
         # Store original parameters in case we want to go back to them later.
         self._original_parameters = self._optimizer.get_numeric_parameters()
+        self._applied_job = None
         self._undo_button.setVisible(False)
         self._enable_gui(False)
 
-        # Configure which parameters are constants (fix) and which should be optimized (free).
-        for index, checkbox in enumerate(self._parameter_checkboxes):
-            if not checkbox.isChecked():
-                self._optimizer.fix_parameter(index)
-            else:
-                self._optimizer.free_parameter(index)
-
+        self._configure_free_parameters()
         self._set_input_images()
 
         from napari._qt.qthreading import thread_worker
@@ -121,13 +165,18 @@ class WorkflowOptimizer(QWidget):
         self._maxiter = self.maxiter_select.value
 
         # Optimization runs in a background thread
+        reference = self.reference_select.value.data
+        # 4D references are time-lapse annotations, see napari-time-slicer
+        timelapse = len(reference.shape) == 4
+
         @thread_worker
         def optimize_runner():
             yield self._optimizer.optimize(
                 self.labels_select.value.name,
-                self.reference_select.value.data,
+                reference,
                 maxiter=self._maxiter,
-                debug_output=True)
+                debug_output=True,
+                timelapse=timelapse)
 
         # Update progress/status in a separate thread
         @thread_worker
@@ -141,6 +190,12 @@ class WorkflowOptimizer(QWidget):
                 else:
                     return
 
+        live_preview = None
+        if self._live_update_checkbox.isChecked():
+            from ._live_preview import LivePreview
+            live_preview = LivePreview(self.viewer, self._optimizer, self.labels_select.value,
+                                       downsample=self._preview_downsample_select.value)
+
         # In case progress is updated, update the GUI from the main thread:
         self._iteration_count = 0
         def yield_progress(is_running):
@@ -153,16 +208,18 @@ class WorkflowOptimizer(QWidget):
                 if self._iteration_count != len(quality):
                     self._iteration_count = len(quality)
                     self._plot_quality()
-                    if self._live_update_checkbox.isChecked():
-                        self._optimizer.set_numeric_parameters(self._optimizer.get_best_result())
-                        self.update_viewer()
+                if live_preview is not None:
+                    live_preview.update()
             #print("Status updated")
 
         # When the optimization is done, update the GUI from the main thread:
         def yield_result(best_result):
+            if live_preview is not None:
+                live_preview.remove()
             self._optimizer.set_numeric_parameters(best_result)
             self._plot_quality()
             self._push_button.setText("Start optimization again")
+            self._push_button.setToolTip("Last optimization stopped: " + str(self._optimizer.get_stop_reason()))
 
             self._undo_button.setVisible(True)
             self._enable_gui(True)
@@ -180,6 +237,122 @@ class WorkflowOptimizer(QWidget):
         if not _for_testing:
             status_worker.start()
 
+    def _configure_free_parameters(self):
+        # Configure which parameters are constants (fix) and which should be optimized (free).
+        for index, checkbox in enumerate(self._parameter_checkboxes):
+            if not checkbox.isChecked():
+                self._optimizer.fix_parameter(index)
+            else:
+                self._optimizer.free_parameter(index)
+
+    def _on_sensitivity_click(self, _for_testing=False):
+        if self._optimizer.is_running():
+            warnings.warn("Cannot analyse sensitivity while optimizer is running.")
+            return
+        self._configure_free_parameters()
+        self._set_input_images()
+        self._enable_gui(False)
+        self._push_button.setEnabled(False)
+        self._sensitivity_label.setText("Analysing sensitivity...")
+
+        from napari._qt.qthreading import thread_worker
+
+        target = self.labels_select.value.name
+        reference = self.reference_select.value.data
+        timelapse = len(reference.shape) == 4
+
+        @thread_worker
+        def sensitivity_runner():
+            # several step sizes, so that parameters are not deselected because a small step stays on a plateau
+            yield self._optimizer.analyse_sensitivity(target, reference, relative_step=[0.05, 0.1, 0.2, 0.4],
+                                                      fix_insensitive=True, timelapse=timelapse)
+
+        def yield_result(sensitivities):
+            names = self._optimizer.get_all_numeric_parameter_names()
+            ranking = [i for i in np.argsort(-sensitivities) if not np.isnan(sensitivities[i])]
+            text = "Sensitivity ranking:"
+            for rank, i in enumerate(ranking):
+                layer_name, parameter_name = names[i]
+                text = text + "\n" + str(rank + 1) + ". " + short_text(layer_name) + " " + parameter_name + \
+                       ": " + "{:.4f}".format(sensitivities[i])
+                # parameters without influence become constants
+                self._parameter_checkboxes[i].setChecked(self._optimizer._fixed_parameters[i] == 0)
+            self._sensitivity_label.setText(text)
+            self._enable_gui(True)
+            self._push_button.setEnabled(True)
+
+        def show_error(error):
+            self._sensitivity_label.setText("Sensitivity analysis failed: " + str(error))
+            self._enable_gui(True)
+            self._push_button.setEnabled(True)
+
+        worker = sensitivity_runner()
+        worker.yielded.connect(yield_result)
+        worker.errored.connect(show_error)
+        if not _for_testing:
+            worker.start()
+
+    def _on_queue_click(self):
+        from .._jobs import JobQueue, OptimizationJob
+        if self._optimizer.is_running():
+            warnings.warn("Cannot queue an optimization while optimizer is running.")
+            return
+        if self._job_queue is None:
+            self._job_queue = JobQueue(self._manager.workflow, optimizer=self._optimizer)
+        self._set_input_images()
+
+        reference = self.reference_select.value.data
+        free_parameters = [i for i, checkbox in enumerate(self._parameter_checkboxes) if checkbox.isChecked()]
+        self._job_queue.submit(OptimizationJob(self.labels_select.value.name, reference,
+                                               free_parameters=free_parameters,
+                                               budget=self.maxiter_select.value,
+                                               timelapse=len(reference.shape) == 4))
+        self._job_list.setVisible(True)
+        self._apply_job_button.setVisible(True)
+        self._cancel_job_button.setVisible(True)
+        self._update_job_list()
+        self._job_timer.start(500)
+
+    def _update_job_list(self):
+        jobs = self._job_queue.get_jobs()
+        while self._job_list.count() < len(jobs):
+            self._job_list.addItem("")
+        for i, job in enumerate(jobs):
+            done, budget = job.get_progress()
+            text = str(i + 1) + ". " + short_text(job.target_task) + ": " + job.status
+            if job.status == "running":
+                text = text + " (" + str(done) + "/" + str(budget) + ")"
+            self._job_list.item(i).setText(text)
+        if all(job.is_done() for job in jobs):
+            self._job_timer.stop()
+
+    def _on_apply_job_click(self):
+        if self._optimizer.is_running():
+            warnings.warn("Cannot apply a result while optimizer is running.")
+            return
+        row = self._job_list.currentRow()
+        if row < 0:
+            return
+        job = self._job_queue.get_jobs()[row]
+        if job.get_result() is None:
+            warnings.warn("The selected optimization has no result yet.")
+            return
+        try:
+            self._job_queue.apply(job)
+        except ValueError as e:
+            warnings.warn(str(e))
+            return
+        self._applied_job = job
+        self._undo_button.setVisible(True)
+        self.update_viewer()
+
+    def _on_cancel_job_click(self):
+        row = self._job_list.currentRow()
+        if row < 0:
+            return
+        self._job_queue.get_jobs()[row].cancel()
+        self._update_job_list()
+
     def _set_input_images(self):
         # Before we can optimize the workflow, we need to pass input images.
         # Those are all layers that are not computed. Hence, we pass all layer-data
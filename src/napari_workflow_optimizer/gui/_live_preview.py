@@ -0,0 +1,92 @@
+import time
+
+import numpy as np
+
+
+class LivePreview():
+    """
+    Shows the best result of a running optimization in a separate layer.
+
+    The preview is computed in a background thread on a copy of the workflow with the best parameters so far,
+    so that the optimizer's workflow and the viewer's layers are not touched during optimization. Updates are
+    rate-limited to one every min_interval seconds and input images can be downsampled to speed them up.
+    """
+    def __init__(self, viewer, optimizer, target_layer, min_interval: float = 1, downsample: int = 1):
+        self._viewer = viewer
+        self._optimizer = optimizer
+        self._target_layer = target_layer
+        self._min_interval = min_interval
+        self._downsample = downsample
+        self._busy = False
+        self._last_update = 0
+        self._shown_parameters = None
+        self._layer = None
+        self._worker = None
+        self._closed = False
+
+    def update(self):
+        """
+        Starts computing a new preview if the best result changed and the last update is long enough ago.
+        Must be called from the main thread.
+        """
+        if self._closed or self._busy or time.time() - self._last_update < self._min_interval:
+            return
+        best = self._optimizer.get_best_result()
+        if best is None or (self._shown_parameters is not None and np.array_equal(best, self._shown_parameters)):
+            return
+
+        self._busy = True
+        self._last_update = time.time()
+        self._shown_parameters = best
+        workflow = self._optimizer._workflow_with_parameters(self._optimizer.get_all_numeric_parameters_for(best))
+        if self._downsample > 1:
+            downsample_inputs(workflow, self._downsample)
+        target = self._target_layer.name
+
+        from napari._qt.qthreading import thread_worker
+
+        @thread_worker
+        def preview_runner():
+            yield np.asarray(workflow.get(target))
+
+        def show(result):
+            # the optimization may have finished while the preview was computed
+            if self._closed:
+                return
+            scale = list(self._target_layer.scale[-result.ndim:])
+            scale[-2] *= self._downsample
+            scale[-1] *= self._downsample
+            if self._layer is None or self._layer not in self._viewer.layers:
+                self._layer = self._viewer.add_labels(result, name=target + " (live preview)", scale=scale)
+            else:
+                self._layer.data = result
+                self._layer.scale = scale
+
+        def done():
+            self._busy = False
+
+        self._worker = preview_runner()
+        self._worker.yielded.connect(show)
+        self._worker.finished.connect(done)
+        self._worker.start()
+
+    def remove(self):
+        """
+        Removes the preview layer from the viewer. A preview which is still computed is not shown anymore.
+        """
+        self._closed = True
+        if self._worker is not None:
+            self._worker.quit()
+        if self._layer is not None and self._layer in self._viewer.layers:
+            self._viewer.layers.remove(self._layer)
+        self._layer = None
+
+
+def downsample_inputs(workflow, factor: int):
+    """
+    Replaces all images in a workflow which are not computed by every factor-th pixel in the last two dimensions.
+    """
+    for name, task in workflow._tasks.items():
+        if hasattr(task, "shape") and hasattr(task, "dtype") and len(task.shape) >= 2:
+            slicing = (Ellipsis, slice(None, None, factor), slice(None, None, factor))
+            workflow.set_task(name, task[slicing])